@@ -0,0 +1,219 @@
+import asyncio
+import random
+import time
+
+from aiobotocore.config import AioConfig
+from botocore.exceptions import ClientError
+
+
+# Error codes in errorEntries that are worth sending again. Other codes, such as
+# TimestampOutOfRangeException or InvalidRequestException, fail the same way every time
+RETRYABLE_ERROR_CODES = {
+    'ThrottlingException',
+    'InternalFailureException',
+    'ServiceUnavailableException',
+    'LimitExceededException',
+}
+MAX_ATTEMPTS = 5
+
+
+def _timestamp_key(timestamp):
+    return timestamp['timeInSeconds'], timestamp.get('offsetInNanos', 0)
+
+
+def split_error_entries(entries, error_entries):
+    """
+    Splits the errorEntries of a batch put response into the entries to send again (containing
+    only the failed property values with a retryable error code) and the errors to give up on.
+    """
+    entries_by_id = {e['entryId']: e for e in entries}
+    retry_entries, fatal_error_entries = [], []
+    for error_entry in error_entries:
+        entry = entries_by_id[error_entry['entryId']]
+        retry_timestamps = set()
+        retry_all = False
+        fatal_errors = []
+        for error in error_entry.get('errors', []):
+            if error['errorCode'] not in RETRYABLE_ERROR_CODES:
+                fatal_errors.append(error)
+            elif error.get('timestamps'):
+                retry_timestamps.update(_timestamp_key(t) for t in error['timestamps'])
+            else:
+                retry_all = True
+
+        values = [v for v in entry['propertyValues']
+                  if retry_all or _timestamp_key(v['timestamp']) in retry_timestamps]
+        if values:
+            retry_entries.append({**entry, 'propertyValues': values})
+        if fatal_errors:
+            fatal_error_entries.append({**error_entry, 'errors': fatal_errors})
+    return retry_entries, fatal_error_entries
+
+
+def retryable_error_entries(error_entries):
+    return [{**entry, 'errors': errors}
+            for entry in error_entries
+            if (errors := [e for e in entry.get('errors', []) if e['errorCode'] in RETRYABLE_ERROR_CODES])]
+
+
+def is_throttled(error_entries):
+    return any(error['errorCode'] == 'ThrottlingException'
+               for entry in error_entries
+               for error in entry.get('errors', []))
+
+
+def failed_error_entries(entries, error_code, error_message):
+    # Error entries (in the errorEntries format) for all the values of entries that were never sent
+    return [{'entryId': entry['entryId'],
+             'errors': [{'errorCode': error_code,
+                         'errorMessage': error_message,
+                         'timestamps': [v['timestamp'] for v in entry['propertyValues']]}]}
+            for entry in entries]
+
+
+def sender_client_config(max_window):
+    """
+    Config for the client used by AsyncBatchSender: one connection per request in flight,
+    and no retries inside botocore, so that the window really is the number of requests in
+    flight and every throttled request reaches the window controller.
+    """
+    return AioConfig(max_pool_connections=max_window, retries={'mode': 'standard', 'total_max_attempts': 1})
+
+
+def put_with_retry(sitewise, entries, max_attempts=MAX_ATTEMPTS):
+    """
+    Sends a batch with a (synchronous) boto3 client, resending only the failed property
+    values. Returns the responses and the error entries that could not be sent.
+    """
+    responses, fatal_error_entries = [], []
+    for attempt in range(1, max_attempts + 1):
+        response = sitewise.batch_put_asset_property_value(entries=entries)
+        responses.append(response)
+        entries, fatal = split_error_entries(entries, response.get('errorEntries', []))
+        fatal_error_entries.extend(fatal)
+        if not entries:
+            break
+        if attempt < max_attempts:
+            print(f'Resending {len(entries)} failed entries (attempt {attempt + 1})')
+            time.sleep(random.uniform(0, 0.1 * 2**attempt))
+    else:
+        fatal_error_entries.extend(retryable_error_entries(response['errorEntries']))
+    return responses, fatal_error_entries
+
+
+async def _aiter(iterable):
+    for item in iterable:
+        yield item
+
+
+async def iter_in_thread(iterable):
+    """
+    Iterates over a (synchronous) iterable in a worker thread, for iterables that block, e.g.
+    on file reads or API calls, so they don't hold up the requests in flight
+    """
+    loop = asyncio.get_running_loop()
+    iterator = iter(iterable)
+    done = object()
+    while (item := await loop.run_in_executor(None, next, iterator, done)) is not done:
+        yield item
+
+
+class AsyncBatchSender:
+    """
+    Sends BatchPutAssetPropertyValue requests with a bounded number of requests in flight.
+
+    The in-flight window grows additively (by about one request per window of successful
+    requests) and is halved when a request is throttled, so the send rate settles at whatever
+    the account quota allows. Throttles of requests sent before the last decrease are ignored,
+    so requests throttled together only halve the window once. Property values that fail with
+    a retryable error code are sent again on their own, without resending the rest of the
+    batch.
+    """
+
+    def __init__(self, sitewise, max_window=32, initial_window=4, max_attempts=MAX_ATTEMPTS):
+        self.sitewise = sitewise
+        self.max_attempts = max_attempts
+        self.max_window = max_window
+        self.window = min(initial_window, max_window)
+        self.num_values = 0
+        self.num_requests = 0
+        self.num_throttled = 0
+        # Sequence number of the last request sent before the window was last decreased
+        self.last_decrease = 0
+        self.error_entries = []
+
+    def _on_success(self):
+        self.window = min(self.max_window, self.window + 1 / self.window)
+
+    def _on_throttled(self, seq):
+        self.num_throttled += 1
+        if seq > self.last_decrease:
+            self.window = max(1, self.window / 2)
+            self.last_decrease = self.num_requests
+
+    async def _put(self, entries):
+        # Returns the request's sequence number and response, or None if the request still
+        # fails with a retryable error after max_attempts
+        backoff = 0.1
+        for attempt in range(1, self.max_attempts + 1):
+            self.num_requests += 1
+            seq = self.num_requests
+            try:
+                return seq, await self.sitewise.batch_put_asset_property_value(entries=entries)
+            except ClientError as e:
+                error = e.response['Error']
+                if error['Code'] not in RETRYABLE_ERROR_CODES:
+                    raise
+                if error['Code'] == 'ThrottlingException':
+                    self._on_throttled(seq)
+                if attempt == self.max_attempts:
+                    self.error_entries.extend(failed_error_entries(entries, error['Code'], error.get('Message', '')))
+                    return None
+                await asyncio.sleep(random.uniform(0, backoff))
+                backoff = min(backoff * 2, 5)
+
+    async def _send(self, entries):
+        self.num_values += sum(len(e['propertyValues']) for e in entries)
+        for attempt in range(1, self.max_attempts + 1):
+            result = await self._put(entries)
+            if result is None:
+                return
+            seq, response = result
+            error_entries = response.get('errorEntries', [])
+            if is_throttled(error_entries):
+                self._on_throttled(seq)
+            else:
+                self._on_success()
+
+            entries, fatal_error_entries = split_error_entries(entries, error_entries)
+            self.error_entries.extend(fatal_error_entries)
+            if not entries:
+                break
+            if attempt < self.max_attempts:
+                await asyncio.sleep(random.uniform(0, 0.1 * 2**attempt))
+        else:
+            self.error_entries.extend(retryable_error_entries(error_entries))
+
+    async def send_all(self, batches):
+        # batches can be an iterable or an async iterable
+        if not hasattr(batches, '__aiter__'):
+            batches = _aiter(batches)
+        start = time.perf_counter()
+        in_flight = set()
+        async for entries in batches:
+            while len(in_flight) >= int(self.window):
+                done, in_flight = await asyncio.wait(in_flight, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    task.result()
+            in_flight.add(asyncio.ensure_future(self._send(entries)))
+        if in_flight:
+            done, _ = await asyncio.wait(in_flight)
+            for task in done:
+                task.result()
+
+        elapsed = time.perf_counter() - start
+        rate = self.num_values / elapsed if elapsed else 0
+        print(f'Sent {self.num_values} values in {self.num_requests} requests '
+              f'({elapsed:0.1f}s, {rate:0.0f} points/s, {self.num_throttled} throttled, '
+              f'final window {int(self.window)})')
+        return self.error_entries
@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+
+# Compares parse_value() in send_property_value.py against the previous implementation
+# (regex, then strtobool, then NullValue.from_str, then the alarm re.split, using exceptions
+# for control flow) on a million mixed values
+
+import json
+import random
+import re
+import time
+
+from send_property_value import alarm_state_value, parse_value
+
+
+NUM_VALUES = 1_000_000
+SAMPLE_VALUES = ['12.5', '-0.25', '3', '-42', 'True', 'false', 'null-d', 'a', 'l/7le9',
+                 'a/12.4/10.0', 'test value', 'running']
+
+
+def strtobool(value_str):
+    # distutils.util.strtobool, which the previous implementation used (distutils was removed
+    # in Python 3.12)
+    value_str = value_str.lower()
+    if value_str in ('y', 'yes', 't', 'true', 'on', '1'):
+        return 1
+    elif value_str in ('n', 'no', 'f', 'false', 'off', '0'):
+        return 0
+    raise ValueError(f'invalid truth value {value_str!r}')
+
+
+class NullValue:
+    def __init__(self, value_type):
+        self.value_type = value_type
+
+    @staticmethod
+    def from_str(s):
+        if s.lower().startswith('null-'):
+            value_type = s.split('-')[1].upper()
+            return NullValue(value_type)
+        else:
+            raise ValueError('Not a null value')
+
+
+def cast_value(value_str):
+    if re.match(r'^-?(\d+)?(\.\d+)?$', value_str):
+        return float(value_str) if '.' in value_str else int(value_str)
+    try:
+        return bool(strtobool(value_str))
+    except ValueError: pass
+    try:
+        return NullValue.from_str(value_str)
+    except ValueError: pass
+    try:
+        return json.dumps(alarm_state_value(value_str))
+    except KeyError: pass
+    return value_str
+
+
+def legacy_parse_value(value_str):
+    value = cast_value(value_str)
+
+    if isinstance(value, bool):
+        return {'booleanValue': value}
+    elif isinstance(value, int):
+        return {'integerValue': value}
+    elif isinstance(value, float):
+        return {'doubleValue': value}
+    elif isinstance(value, NullValue):
+        return {'nullValue': {'valueType': value.value_type}}
+    else:
+        return {'stringValue': value}
+
+
+def values_per_sec(func, values):
+    start = time.perf_counter()
+    for value in values:
+        func(value)
+    return len(values) / (time.perf_counter() - start)
+
+
+if __name__ == '__main__':
+    for value in SAMPLE_VALUES:
+        assert parse_value(value) == legacy_parse_value(value), value
+
+    values = random.choices(SAMPLE_VALUES, k=NUM_VALUES)
+    doubles = [f'{random.uniform(-100, 100):.3f}' for _ in range(NUM_VALUES)]
+
+    legacy_rate = values_per_sec(legacy_parse_value, values)
+    inferred_rate = values_per_sec(parse_value, values)
+    declared_rate = values_per_sec(lambda v: parse_value(v, 'DOUBLE'), doubles)
+    print(f'Previous implementation:   {legacy_rate:>12,.0f} values/s')
+    print(f'parse_value (inferred):    {inferred_rate:>12,.0f} values/s ({inferred_rate / legacy_rate:0.1f}x)')
+    print(f'parse_value (DOUBLE type): {declared_rate:>12,.0f} values/s')
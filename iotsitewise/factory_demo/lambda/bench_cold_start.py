@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+
+# Times cold (module import + first invocation) and warm invocations of the Lambda handlers,
+# running them locally against stubbed AWS clients. Each handler runs in a fresh process, so
+# every cold start pays for its own imports.
+#
+# > python3 bench_cold_start.py -n 20
+
+import argparse
+import importlib.machinery
+import importlib.util
+import json
+import multiprocessing
+import os
+import statistics
+import sys
+import tempfile
+import time
+import uuid
+from pathlib import Path
+
+
+DIRECTORY = Path(__file__).parent.absolute()
+NUM_GENERATOR_PROPERTIES = 200
+NUM_ALARM_RECORDS = 20
+
+
+def load_module(name, filename):
+    # The CW alarm function is stored as a template, so the module is loaded from its file
+    loader = importlib.machinery.SourceFileLoader(name, str(DIRECTORY / filename))
+    spec = importlib.util.spec_from_loader(name, loader)
+    module = importlib.util.module_from_spec(spec)
+    loader.exec_module(module)
+    return module
+
+
+def stub(client, operation, response, count):
+    from botocore.stub import Stubber
+    stubber = Stubber(client)
+    for _ in range(count):
+        stubber.add_response(operation, response)
+    stubber.activate()
+    return stubber
+
+
+def measurement_gen_setup(module):
+    num_batches = (NUM_GENERATOR_PROPERTIES + 9) // 10
+    event = {'time': '2024-01-01T00:00:05Z'}
+    return event, lambda: [stub(module.sitewise_client, 'batch_put_asset_property_value', {'errorEntries': []}, num_batches)]
+
+
+def cw_sender_setup(module):
+    event = {'payload': {
+        'assetId': str(uuid.uuid4()),
+        'propertyId': str(uuid.uuid4()),
+        'values': [{'value': {'doubleValue': float(i)}, 'timestamp': {'timeInSeconds': 1704067200 + i}}
+                   for i in range(100)]
+    }}
+    return event, lambda: [stub(module.cw_client, 'put_metric_data', {}, 1)]
+
+
+def cw_alarm_setup(module):
+    tags = {'Tags': [{'Key': 'alarm_asset_id', 'Value': str(uuid.uuid4())},
+                     {'Key': 'alarm_property_id', 'Value': str(uuid.uuid4())}]}
+    records = [{'Sns': {'Message': json.dumps({
+        'AlarmArn': f'arn:aws:cloudwatch:us-west-2:123456789012:alarm:alarm-{i}',
+        'StateChangeTime': '2024-01-01T00:00:00.000+0000',
+        'NewStateValue': 'ALARM',
+        'NewStateReason': 'Threshold Crossed: 1 datapoint [95.0 (01/01/24 00:00:00)] was greater than the threshold (90.0).',
+        'Trigger': {'Threshold': 90.0, 'ComparisonOperator': 'GreaterThanThreshold'},
+    })}} for i in range(NUM_ALARM_RECORDS)]
+    num_batches = (NUM_ALARM_RECORDS + 9) // 10
+
+    # The tags are only looked up until they're cached, on the first invocation
+    first_call = [True]
+    def stubbers():
+        num_tag_calls = NUM_ALARM_RECORDS if first_call[0] else 0
+        first_call[0] = False
+        return [stub(module.cw_client, 'list_tags_for_resource', tags, num_tag_calls),
+                stub(module.sitewise_client, 'batch_put_asset_property_value', {'errorEntries': []}, num_batches)]
+    return {'Records': records}, stubbers
+
+
+HANDLERS = {
+    'measurement_gen': ('measurement_gen.py', measurement_gen_setup),
+    'cw_sender': ('cw_sender.py', cw_sender_setup),
+    'cw_alarm_to_sitewise': ('cw_alarm_to_sitewise.py.j2', cw_alarm_setup),
+}
+
+
+def invoke(module, event, stubbers):
+    active = stubbers()
+    start = time.perf_counter()
+    module.handler(event, None)
+    elapsed = time.perf_counter() - start
+    for stubber in active:
+        stubber.assert_no_pending_responses()
+        stubber.deactivate()
+    return elapsed
+
+
+def run(name, num_warm):
+    filename, setup = HANDLERS[name]
+    # The handlers' logging would swamp the results
+    sys.stdout = open(os.devnull, 'w')
+
+    start = time.perf_counter()
+    module = load_module(name, filename)
+    import_time = time.perf_counter() - start
+    event, stubbers = setup(module)
+    first_invocation = invoke(module, event, stubbers)
+    warm = [invoke(module, event, stubbers) for _ in range(num_warm)]
+    return import_time, first_invocation, warm
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--num-warm', type=int, default=20, help='Warm invocations per handler')
+    args = parser.parse_args()
+
+    id_table = tempfile.NamedTemporaryFile(suffix='.bin', delete=False)
+    id_table.write(os.urandom(32 * NUM_GENERATOR_PROPERTIES))
+    id_table.close()
+    os.environ.update({
+        'AWS_DEFAULT_REGION': 'us-west-2',
+        'AWS_ACCESS_KEY_ID': 'testing',
+        'AWS_SECRET_ACCESS_KEY': 'testing',
+        'ID_TABLE_URI': id_table.name,
+        'MAX_TPS': '100000',
+    })
+    sys.path.insert(0, str(DIRECTORY))
+    sys.path.insert(0, str(DIRECTORY.parent.parent))
+
+    ctx = multiprocessing.get_context('spawn')
+    print(f"{'Handler':<22} {'Import (ms)':>12} {'First call (ms)':>16} {'Warm p50 (ms)':>14} {'Warm max (ms)':>14}")
+    try:
+        for name in HANDLERS:
+            with ctx.Pool(1) as pool:
+                import_time, first_invocation, warm = pool.apply(run, (name, args.num_warm))
+            print(f'{name:<22} {import_time * 1000:>12.1f} {first_invocation * 1000:>16.1f} '
+                  f'{statistics.median(warm) * 1000:>14.1f} {max(warm) * 1000:>14.1f}')
+    finally:
+        os.unlink(id_table.name)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,44 +1,145 @@
 #!/usr/bin/env python3
 
 import boto3
+import os
+import time
+from botocore.config import Config
 from botocore.exceptions import ClientError
 from datetime import datetime
 
 
-def value_to_metric_data(value, asset_id, property_id):
-    timestamp = datetime.fromtimestamp(value['timestamp']['timeInSeconds'])
-    value_type = list(value['value'].keys())[0]
-    prop_value = 'null' if value_type == 'nullValue' else value['value'][value_type]
-    quality = value.get('quality', 'UNKNOWN')
-    return {
-        'MetricName': f'Property_{property_id}',
-        'Value': prop_value,
-        'Timestamp': timestamp,
-        'Dimensions': [
-            {
-                'Name': 'AssetId',
-                'Value': asset_id
-            },
-            {
-                'Name': 'Quality',
-                'Value': quality
-            }
-        ]
-    }
+NAMESPACE = 'IoTSiteWise/AssetMetrics'
+# PutMetricData limits: metrics per request, and items in the Values/Counts arrays of a metric
+MAX_METRICS_PER_REQUEST = 1000
+MAX_VALUES_PER_METRIC = 150
+# Number of metrics to buffer across notifications before sending (0 sends every notification
+# straight away), and the maximum age (seconds) of the buffer before it's sent regardless
+BUFFER_SIZE = int(os.environ.get('BUFFER_SIZE', '0'))
+BUFFER_MAX_AGE = float(os.environ.get('BUFFER_MAX_AGE', '60'))
+
+# Created once per container
+cw_client = boto3.client(service_name='cloudwatch',
+                         config=Config(tcp_keepalive=True, retries={'mode': 'adaptive', 'max_attempts': 5}))
+
+
+class MetricBuffer:
+    """
+    Collects property values as CloudWatch metrics, collapsing values of the same property,
+    quality and timestamp into a single metric with Values/Counts arrays.
+
+    A buffer kept across invocations lives in the Lambda container, so values that are still
+    buffered when the container is shut down are lost.
+    """
+
+    def __init__(self):
+        # (property ID, asset ID, quality, timestamp) -> {value: count}
+        self.metrics = {}
+        self.created = time.monotonic()
+
+    def __len__(self):
+        return len(self.metrics)
+
+    def age(self):
+        return time.monotonic() - self.created
+
+    def add(self, asset_id, property_id, values):
+        skipped = 0
+        for value in values:
+            value_type = list(value['value'].keys())[0]
+            if value_type in ('nullValue', 'stringValue'):
+                # CloudWatch metric values have to be numbers
+                skipped += 1
+                continue
+            key = (property_id, asset_id, value.get('quality', 'UNKNOWN'), value['timestamp']['timeInSeconds'])
+            counts = self.metrics.setdefault(key, {})
+            prop_value = float(value['value'][value_type])
+            counts[prop_value] = counts.get(prop_value, 0) + 1
+        if skipped:
+            print(f'Skipped {skipped} values that are not numbers')
+
+    def remove(self, key, values):
+        counts = self.metrics[key]
+        for value in values:
+            del counts[value]
+        if not counts:
+            del self.metrics[key]
+
+    def metric_data(self):
+        # Yields (buffer key, metric datum) pairs
+        for key, counts in self.metrics.items():
+            property_id, asset_id, quality, timestamp = key
+            items = list(counts.items())
+            for i in range(0, len(items), MAX_VALUES_PER_METRIC):
+                chunk = items[i:i+MAX_VALUES_PER_METRIC]
+                yield key, {
+                    'MetricName': f'Property_{property_id}',
+                    'Values': [v for v, _ in chunk],
+                    'Counts': [c for _, c in chunk],
+                    'Timestamp': datetime.fromtimestamp(timestamp),
+                    'Dimensions': [
+                        {
+                            'Name': 'AssetId',
+                            'Value': asset_id
+                        },
+                        {
+                            'Name': 'Quality',
+                            'Value': quality
+                        }
+                    ]
+                }
+
+
+def chunks(iterable, n):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == n:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def flush(cw_client, buffer):
+    """
+    Sends the buffered metrics, removing them from the buffer as they're sent. Stops and
+    raises the error if a request fails, leaving the unsent metrics in the buffer.
+    """
+    num_metrics = len(buffer)
+    num_requests = 0
+    for chunk in chunks(list(buffer.metric_data()), MAX_METRICS_PER_REQUEST):
+        try:
+            response = cw_client.put_metric_data(Namespace=NAMESPACE, MetricData=[datum for _, datum in chunk])
+        except ClientError as e:
+            print('ERROR: Failed to send metrics to CloudWatch:', e)
+            raise
+        for key, datum in chunk:
+            buffer.remove(key, datum['Values'])
+        num_requests += 1
+        print(f'Sent {len(chunk)} metrics to CW.', response)
+    print(f'Sent {num_metrics} buffered metrics in {num_requests} requests')
+
+
+buffer = MetricBuffer()
 
 
 def handler(event, context):
+    global buffer
     print('Event:', event)
-    cw_client = boto3.client(service_name='cloudwatch')
 
     payload = event['payload']
-    metric_data = [value_to_metric_data(value, payload['assetId'], payload['propertyId'])
-                   for value in payload['values']]
-    params = {
-        'Namespace': 'IoTSiteWise/AssetMetrics',
-        'MetricData': metric_data
-    }
-    print(f'Sending metrics to CloudWatch: {params}')
-
-    response = cw_client.put_metric_data(**params)
-    print('Sent to CW.', response)
+    buffer.add(payload['assetId'], payload['propertyId'], payload['values'])
+    if len(buffer) >= BUFFER_SIZE or buffer.age() >= BUFFER_MAX_AGE:
+        try:
+            flush(cw_client, buffer)
+        except ClientError:
+            if BUFFER_SIZE == 0:
+                # The buffer only holds this notification's values, so the invocation fails
+                # and a retry sends them again
+                buffer = MetricBuffer()
+                raise
+            # Values of earlier notifications can't be sent again by a retry of this one, so
+            # the unsent metrics are kept for the next flush
+            print(f'Keeping {len(buffer)} unsent metrics in the buffer')
+            return
+        buffer = MetricBuffer()
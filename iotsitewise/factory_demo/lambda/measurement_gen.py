@@ -0,0 +1,99 @@
+import boto3
+import functools
+import logging
+import os
+import uuid
+import numpy as np
+from botocore.config import Config
+from datetime import datetime
+
+import signal_models
+from pacer import send_batches
+
+
+logger = logging.getLogger()
+logger.setLevel(os.environ.get('LOG_LEVEL', 'INFO'))
+
+# Location of the (asset ID, property ID) table, either s3://<bucket>/<key> or a local file.
+# Each row is the 16 byte asset UUID followed by the 16 byte property UUID
+ID_TABLE_URI = os.environ['ID_TABLE_URI']
+ID_ROW_SIZE = 32
+# BatchPutAssetPropertyValue requests per second (shared by all the batches of a tick)
+MAX_TPS = float(os.environ.get('MAX_TPS', '10'))
+MAX_WORKERS = int(os.environ.get('MAX_WORKERS', '10'))
+
+# Clients are created once per container. The connection pool fits all the sender threads
+client_config = Config(tcp_keepalive=True, max_pool_connections=MAX_WORKERS,
+                       retries={'mode': 'adaptive', 'max_attempts': 5})
+s3_client = boto3.client(service_name='s3', config=client_config)
+sitewise_client = boto3.client(service_name='iotsitewise', config=client_config)
+rng = np.random.default_rng()
+
+
+def unpack_id_table(data):
+    return [(str(uuid.UUID(bytes=data[i:i+16])), str(uuid.UUID(bytes=data[i+16:i+ID_ROW_SIZE])))
+            for i in range(0, len(data), ID_ROW_SIZE)]
+
+
+def id_table_version(uri):
+    if uri.startswith('s3://'):
+        bucket, key = uri[5:].split('/', 1)
+        return s3_client.head_object(Bucket=bucket, Key=key)['ETag']
+    return os.stat(uri).st_mtime_ns
+
+
+@functools.lru_cache(maxsize=1)
+def load_id_table(uri, version):
+    # Memoized on the object version, so warm containers only download the table again
+    # after the asset/property topology has changed
+    if uri.startswith('s3://'):
+        bucket, key = uri[5:].split('/', 1)
+        data = s3_client.get_object(Bucket=bucket, Key=key)['Body'].read()
+    else:
+        with open(uri, 'rb') as f:
+            data = f.read()
+    asset_properties = unpack_id_table(data)
+    print(f'Loaded {len(asset_properties)} asset/property IDs from {uri}')
+    return asset_properties
+
+
+@functools.lru_cache(maxsize=1)
+def signal_config(num_properties):
+    # Per-property signal model config (see signal_models.py)
+    return {
+        'model': ['gaussian'] * num_properties,
+        'mean': [10*(6 + idx) for idx in range(num_properties)],
+        'sigma': [5*(1 + idx) for idx in range(num_properties)],
+    }
+
+
+def gen_values(asset_properties, ts_epoch):
+    config = signal_config(len(asset_properties))
+    values = signal_models.generate(config, None, [ts_epoch], rng)[:, 0]
+    for (asset_id, prop_id), value in zip(asset_properties, values.tolist()):
+        yield asset_id, prop_id, value
+
+
+def create_entry(entry_id, timestamp_sec, asset_id, property_id, property_value):
+    return {
+        'entryId': str(entry_id),
+        'assetId': asset_id,
+        'propertyId': property_id,
+        'propertyValues': [{'value': {'doubleValue': property_value},
+                            'timestamp': {'timeInSeconds': timestamp_sec}}]}
+
+
+def chunks(lst, n):
+    for i in range(0, len(lst), n):
+        yield lst[i:i+n]
+
+
+def handler(event, context):
+    print('Event:', event)
+    ts_epoch = int(datetime.fromisoformat(event['time']).replace(second=0).timestamp())
+    asset_properties = load_id_table(ID_TABLE_URI, id_table_version(ID_TABLE_URI))
+    entries = [
+        create_entry(idx, ts_epoch, asset_id, prop_id, prop_value)
+        for idx, (asset_id, prop_id, prop_value) in enumerate(gen_values(asset_properties, ts_epoch))
+    ]
+    send_batches(sitewise_client, chunks(entries, 10), MAX_TPS, MAX_WORKERS)
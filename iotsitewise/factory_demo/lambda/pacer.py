@@ -0,0 +1,78 @@
+import logging
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from botocore.exceptions import ClientError
+
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    """
+    Allows up to `rate` calls per second on average, with bursts of up to `capacity` calls.
+    Thread safe, so one bucket can pace all the requests of an invocation.
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        # At least one token, or a rate below 1 per second could never fill the bucket to 1
+        self.capacity = capacity or max(1, rate)
+        self.tokens = self.capacity
+        self.last_refill = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.last_refill) * self.rate)
+                self.last_refill = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait_time = (1 - self.tokens) / self.rate
+            time.sleep(wait_time)
+
+
+def send_batches(sitewise_client, batches, max_tps, max_workers=10):
+    """
+    Sends the BatchPutAssetPropertyValue batches concurrently, at no more than max_tps
+    requests per second. The batches are taken from the iterable as the senders free up, so
+    they can be generated while earlier batches are being sent. Returns the error entries.
+    """
+    bucket = TokenBucket(max_tps)
+
+    def send(batch):
+        bucket.acquire()
+        logger.debug('Sending batch to SiteWise: %s', batch)
+        try:
+            response = sitewise_client.batch_put_asset_property_value(entries=batch)
+        except ClientError as e:
+            logger.error('Failed to send %d entries to SiteWise: %s', len(batch), e)
+            return [{'entryId': entry['entryId'], 'errors': [e.response['Error']]} for entry in batch]
+        logger.debug('Response: %s', response)
+        return response.get('errorEntries', [])
+
+    start = time.perf_counter()
+    num_batches = num_entries = 0
+    error_entries = []
+    in_flight = set()
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for batch in batches:
+            if len(in_flight) >= 2 * max_workers:
+                done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    error_entries.extend(future.result())
+            in_flight.add(executor.submit(send, batch))
+            num_batches += 1
+            num_entries += len(batch)
+        for future in in_flight:
+            error_entries.extend(future.result())
+
+    logger.info('Sent %d entries in %d batches in %0.2fs (%d failed entries)',
+                num_entries, num_batches, time.perf_counter() - start, len(error_entries))
+    for error_entry in error_entries[:10]:
+        logger.warning('Failed entry: %s', error_entry)
+    return error_entries
@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+
+# Replays synthetic events through the Lambda handlers in-process and reports their latency
+# percentiles, throughput, AWS API calls per record and peak (Python) memory.
+#
+# With --rate, events are scheduled at fixed arrival times whether or not the handler keeps up,
+# and latency is measured from each event's scheduled arrival. Above the handler's capacity it
+# includes the time the event waited for the previous ones, as it would in a queue.
+#
+# The AWS calls never leave the process: the handlers' clients answer every call with a canned
+# response from a botocore before-call hook (the same mechanism Stubber uses). Unlike Stubber,
+# the hook doesn't need to know up front how many calls to expect, which depends on the tag
+# cache and metric buffer state.
+#
+# > python3 replay_handlers.py --events 50 --records 100 --rate 10
+# > python3 replay_handlers.py -H cw_alarm_to_sitewise --records 500 --alarms 5
+
+import argparse
+import contextlib
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+import uuid
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+from botocore.awsrequest import AWSResponse
+
+from bench_cold_start import load_module
+
+
+DIRECTORY = Path(__file__).parent.absolute()
+START_TIME = datetime(2024, 1, 1, tzinfo=timezone.utc)
+
+CANNED_RESPONSES = {
+    'BatchPutAssetPropertyValue': {'errorEntries': []},
+    'PutMetricData': {},
+    'ListTagsForResource': {'Tags': [{'Key': 'alarm_asset_id', 'Value': str(uuid.uuid4())},
+                                     {'Key': 'alarm_property_id', 'Value': str(uuid.uuid4())}]},
+}
+
+
+class ApiCallCounter:
+    """
+    Answers every call made by the clients with its canned response, counting the calls by
+    operation name
+    """
+
+    def __init__(self, *clients):
+        self.calls = Counter()
+        for client in clients:
+            client.meta.events.register('before-call.*.*', self.respond)
+
+    def respond(self, model, **kwargs):
+        self.calls[model.name] += 1
+        return AWSResponse(None, 200, {}, None), CANNED_RESPONSES[model.name]
+
+
+def measurement_gen_events(args):
+    # A scheduled EventBridge event every minute. The number of records is the number of
+    # generator properties, which is set by the size of the ID table
+    for i in range(args.events):
+        yield {
+            'version': '0',
+            'id': str(uuid.uuid4()),
+            'detail-type': 'Scheduled Event',
+            'source': 'aws.events',
+            'time': (START_TIME + timedelta(minutes=i)).strftime('%Y-%m-%dT%H:%M:%SZ'),
+            'resources': [],
+            'detail': {},
+        }, args.records
+
+
+def cw_sender_events(args):
+    # SiteWise property value notifications, with a new value every second
+    asset_id, property_id = str(uuid.uuid4()), str(uuid.uuid4())
+    start_s = int(START_TIME.timestamp())
+    for i in range(args.events):
+        values = [{'value': {'doubleValue': float(j % 50)},
+                   'timestamp': {'timeInSeconds': start_s + i * args.records + j},
+                   'quality': 'GOOD'}
+                  for j in range(args.records)]
+        yield {'type': 'PropertyValueUpdate',
+               'payload': {'assetId': asset_id, 'propertyId': property_id, 'values': values}}, args.records
+
+
+def cw_alarm_events(args):
+    # SNS notifications of alarm state changes, spread over args.alarms alarms
+    for i in range(args.events):
+        records = []
+        for j in range(args.records):
+            message = {
+                'AlarmArn': f'arn:aws:cloudwatch:us-west-2:123456789012:alarm:alarm-{j % args.alarms}',
+                'StateChangeTime': (START_TIME + timedelta(seconds=i)).strftime('%Y-%m-%dT%H:%M:%S.000+0000'),
+                'NewStateValue': 'ALARM' if (i + j) % 2 else 'OK',
+                'NewStateReason': 'Threshold Crossed: 1 datapoint [95.0 (01/01/24 00:00:00)] was greater than the threshold (90.0).',
+                'Trigger': {'Threshold': 90.0, 'ComparisonOperator': 'GreaterThanThreshold'},
+            }
+            records.append({'EventSource': 'aws:sns', 'Sns': {'Message': json.dumps(message)}})
+        yield {'Records': records}, args.records
+
+
+HANDLERS = {
+    'measurement_gen': ('measurement_gen.py', measurement_gen_events, ['s3_client', 'sitewise_client']),
+    'cw_sender': ('cw_sender.py', cw_sender_events, ['cw_client']),
+    'cw_alarm_to_sitewise': ('cw_alarm_to_sitewise.py.j2', cw_alarm_events, ['cw_client', 'sitewise_client']),
+}
+
+
+def percentile(sorted_values, p):
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * p / 100))]
+
+
+def replay(name, args):
+    filename, events, client_names = HANDLERS[name]
+    module = load_module(name, filename)
+    counter = ApiCallCounter(*[getattr(module, client_name) for client_name in client_names])
+
+    latencies = []
+    handler_time = 0
+    num_records = 0
+    interval = 1 / args.rate if args.rate else 0
+    tracemalloc.start()
+    next_time = time.perf_counter()
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        for event, event_records in events(args):
+            # Events arrive at the configured rate, however long the handler takes. One that
+            # arrives while the previous event is still being handled waits for it
+            arrival = next_time
+            if interval:
+                time.sleep(max(0, arrival - time.perf_counter()))
+                next_time += interval
+            start = time.perf_counter()
+            module.handler(event, None)
+            end = time.perf_counter()
+            latencies.append(end - (arrival if interval else start))
+            handler_time += end - start
+            num_records += event_records
+    _, peak_memory = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    latencies.sort()
+    return {
+        'p50': percentile(latencies, 50),
+        'p90': percentile(latencies, 90),
+        'p99': percentile(latencies, 99),
+        'records_per_sec': num_records / handler_time,
+        'calls_per_record': {op: count / num_records for op, count in sorted(counter.calls.items())},
+        'peak_memory': peak_memory,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-H', '--handler', choices=list(HANDLERS), action='append',
+                        help='Handler to replay events through (default: all of them)')
+    parser.add_argument('-e', '--events', type=int, default=20, help='Events per handler')
+    parser.add_argument('-r', '--records', type=int, default=100,
+                        help='Records per event (SNS records, notification values or generator properties)')
+    parser.add_argument('--rate', type=float, default=0, help='Events per second (0: as fast as possible)')
+    parser.add_argument('--alarms', type=int, default=10, help='Number of distinct alarms in the SNS events')
+    parser.add_argument('--max-tps', default='100000', help='MAX_TPS of the SiteWise senders')
+    args = parser.parse_args()
+
+    id_table = tempfile.NamedTemporaryFile(suffix='.bin', delete=False)
+    id_table.write(os.urandom(32 * args.records))
+    id_table.close()
+    os.environ.update({
+        'AWS_DEFAULT_REGION': 'us-west-2',
+        'AWS_ACCESS_KEY_ID': 'testing',
+        'AWS_SECRET_ACCESS_KEY': 'testing',
+        'ID_TABLE_URI': id_table.name,
+        'MAX_TPS': args.max_tps,
+    })
+    sys.path.insert(0, str(DIRECTORY.parent.parent))
+
+    print(f"{'Handler':<22} {'p50 (ms)':>9} {'p90 (ms)':>9} {'p99 (ms)':>9} {'Records/s':>11} "
+          f"{'Peak mem (MB)':>14}  API calls/record")
+    try:
+        for name in args.handler or HANDLERS:
+            result = replay(name, args)
+            calls = ', '.join(f'{op}={n:0.3f}' for op, n in result['calls_per_record'].items())
+            print(f"{name:<22} {result['p50'] * 1000:>9.1f} {result['p90'] * 1000:>9.1f} "
+                  f"{result['p99'] * 1000:>9.1f} {result['records_per_sec']:>11,.0f} "
+                  f"{result['peak_memory'] / 2**20:>14.1f}  {calls}")
+    finally:
+        os.unlink(id_table.name)
+
+
+if __name__ == '__main__':
+    main()
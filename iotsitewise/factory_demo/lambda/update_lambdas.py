@@ -1,52 +1,93 @@
 #!/usr/bin/env python3
 
+import base64
 import boto3
 import click
+import hashlib
 import itertools
 import jinja2
+import uuid
+from concurrent.futures import ThreadPoolExecutor
 from io import BytesIO
 from pathlib import Path
-from zipfile import ZipFile, ZIP_DEFLATED
+from zipfile import ZipFile, ZipInfo, ZIP_DEFLATED
 from tinydb import TinyDB, Query
 
 
 DIRECTORY = Path(__file__).parent.absolute()
+SIGNAL_MODELS_FILE = DIRECTORY.parent.parent / 'signal_models.py'
+# Must match the ID_TABLE_URI environment variable of the Measurement Generator Lambda function
+ID_TABLE_S3_KEY = 'asset_properties.bin'
+ZIP_DATE_TIME = (1980, 1, 1, 0, 0, 0)
 
 # Use Query objects to make ORM-style DB queries
 Model = Query()
 Asset = Query()
 
 
-def update_measurement_gen_lambda(lambda_client, lambda_function_name, template_env, models_db, assets_db):
+def pack_id_table(asset_properties):
+    # 32 bytes per row: the asset UUID bytes followed by the property UUID bytes
+    return b''.join(uuid.UUID(asset_id).bytes + uuid.UUID(prop_id).bytes
+                    for asset_id, prop_id in asset_properties)
+
+
+def update_measurement_gen_id_table(s3_client, s3_bucket, models_db, assets_db):
     generator_model = models_db.get(Model.type == 'generator')
     generator_assets = list(assets_db.search(Asset.type == 'generator'))
 
     asset_ids = [a['id'] for a in generator_assets]
     prop_ids = [generator_model['property_id'][prop_name] for prop_name in ['power', 'temperature_f']]
 
-    template = template_env.get_template('measurement_gen.py.j2')
-    meas_gen_code = template.render(asset_properties=itertools.product(asset_ids, prop_ids))
+    id_table = pack_id_table(itertools.product(asset_ids, prop_ids))
+    s3_client.put_object(Bucket=s3_bucket, Key=ID_TABLE_S3_KEY, Body=id_table)
+    print(f'Uploaded Measurement Generator ID table to s3://{s3_bucket}/{ID_TABLE_S3_KEY}')
+
 
+def build_zip(files):
+    """
+    Zips the {archive name: content} files with fixed timestamps and permissions, so the same
+    sources always give the same zip (and the same CodeSha256)
+    """
     memory_file = BytesIO()
     with ZipFile(memory_file, mode='w', compression=ZIP_DEFLATED) as zf:
-        zf.writestr('index.py', meas_gen_code)
+        for arcname, content in sorted(files.items()):
+            info = ZipInfo(arcname, date_time=ZIP_DATE_TIME)
+            info.compress_type = ZIP_DEFLATED
+            info.external_attr = 0o644 << 16
+            zf.writestr(info, content)
+    return memory_file.getvalue()
 
-    lambda_client.update_function_code(FunctionName=lambda_function_name,
-                                       ZipFile=memory_file.getvalue())
-    print('Updated Measurement Generator Lambda function')
 
+def code_sha256(zip_bytes):
+    # Same format as the CodeSha256 returned by the Lambda API
+    return base64.b64encode(hashlib.sha256(zip_bytes).digest()).decode()
 
-def update_cloudwatch_sender_lambda(lambda_client, lambda_function_name):
-    memory_file = BytesIO()
-    with ZipFile(memory_file, mode='w', compression=ZIP_DEFLATED) as zf:
-        zf.write(f'{DIRECTORY}/cw_sender.py', arcname='index.py')
 
-    lambda_client.update_function_code(FunctionName=lambda_function_name,
-                                       ZipFile=memory_file.getvalue())
-    print('Updated CloudWatch Sender Lambda function')
+def update_function_code(lambda_client, lambda_function_name, files, description):
+    zip_bytes = build_zip(files)
+    function_config = lambda_client.get_function_configuration(FunctionName=lambda_function_name)
+    if function_config['CodeSha256'] == code_sha256(zip_bytes):
+        print(f'{description} Lambda function is up to date')
+        return
+    lambda_client.update_function_code(FunctionName=lambda_function_name, ZipFile=zip_bytes)
+    print(f'Updated {description} Lambda function')
+
 
+def measurement_gen_files():
+    return {
+        'index.py': (DIRECTORY / 'measurement_gen.py').read_bytes(),
+        'signal_models.py': SIGNAL_MODELS_FILE.read_bytes(),
+        'pacer.py': (DIRECTORY / 'pacer.py').read_bytes(),
+    }
 
-def update_cw_alarm_sitewise_sender_lambda(lambda_client, lambda_function_name, template_env, models_db, assets_db):
+
+def cloudwatch_sender_files():
+    return {
+        'index.py': (DIRECTORY / 'cw_sender.py').read_bytes(),
+    }
+
+
+def cw_alarm_sitewise_sender_files(template_env, models_db, assets_db):
     factory_model = models_db.get(Model.type == 'factory')
     factory_asset = assets_db.get(Asset.type == 'factory')
 
@@ -55,13 +96,10 @@ def update_cw_alarm_sitewise_sender_lambda(lambda_client, lambda_function_name,
         asset_id=factory_asset['id'],
         alarm_state_prop_id=factory_model['composite_model_property_id']['power_rate_alarm']['AWS/ALARM_STATE'])
 
-    memory_file = BytesIO()
-    with ZipFile(memory_file, mode='w', compression=ZIP_DEFLATED) as zf:
-        zf.writestr('index.py', sw_alarm_sender_code)
-
-    lambda_client.update_function_code(FunctionName=lambda_function_name,
-                                       ZipFile=memory_file.getvalue())
-    print('Updated CW Alarm State to SiteWise Lambda function')
+    return {
+        'index.py': sw_alarm_sender_code.encode(),
+        'pacer.py': (DIRECTORY / 'pacer.py').read_bytes(),
+    }
 
 
 @click.command(context_settings={'help_option_names': ['-h', '--help']})
@@ -73,12 +111,23 @@ def main(db_filename):
     assets = db.table('assets')
 
     lambda_client = boto3.client('lambda', region_name=config['region'])
+    s3_client = boto3.client('s3', region_name=config['region'])
     template_loader = jinja2.FileSystemLoader(searchpath=DIRECTORY)
     template_env = jinja2.Environment(loader=template_loader)
 
-    update_measurement_gen_lambda(lambda_client, config['meas_gen_function_name'], template_env, models, assets)
-    update_cloudwatch_sender_lambda(lambda_client, config['cw_sender_function_name'])
-    update_cw_alarm_sitewise_sender_lambda(lambda_client, config['cw_alarm_sw_sender_function_name'], template_env, models, assets)
+    update_measurement_gen_id_table(s3_client, config['meas_gen_data_bucket'], models, assets)
+
+    # The functions are independent of each other, so they're updated in parallel
+    functions = [
+        (config['meas_gen_function_name'], measurement_gen_files(), 'Measurement Generator'),
+        (config['cw_sender_function_name'], cloudwatch_sender_files(), 'CloudWatch Sender'),
+        (config['cw_alarm_sw_sender_function_name'], cw_alarm_sitewise_sender_files(template_env, models, assets),
+         'CW Alarm State to SiteWise'),
+    ]
+    with ThreadPoolExecutor(max_workers=len(functions)) as executor:
+        futures = [executor.submit(update_function_code, lambda_client, *function) for function in functions]
+        for future in futures:
+            future.result()
 
 
 if __name__ == '__main__':
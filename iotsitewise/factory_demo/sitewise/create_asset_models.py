@@ -2,6 +2,7 @@
 
 import boto3
 import click
+import itertools
 import time
 from tinydb import TinyDB, Query
 
@@ -115,6 +116,9 @@ def to_db_item(asset_model, asset_model_type):
         'composite_model_property_id': {cm['name']: {p['name']: p['id'] for p in cm['properties']}
                                         for cm in asset_model.get('assetModelCompositeModels', [])},
         'hierarchy_id': asset_model['assetModelHierarchies'][0]['id'] if asset_model['assetModelHierarchies'] else None,
+        'property_data_type': {p['id']: p['dataType']
+                               for p in itertools.chain(asset_model['assetModelProperties'],
+                                                        *(cm['properties'] for cm in asset_model.get('assetModelCompositeModels', [])))},
     }
 
 
@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+
+# Compares building the BatchPutAssetPropertyValue entries with df.iterrows() (the original
+# send_values implementation) against the column-wise iter_entry_batches()
+
+import time
+import uuid
+
+import numpy as np
+import pandas as pd
+
+from gen_measurement import iter_entry_batches
+
+
+SIZES = [1_000, 10_000, 100_000]
+
+
+def iterrows_batches(df, timestamp, batch_size=10):
+    entries = [
+        {
+            'entryId': str(i),
+            'assetId': row['assetId'],
+            'propertyId': row['propertyId'],
+            'propertyValues': [{
+                'value': { 'doubleValue': row['value'] },
+                'timestamp': { 'timeInSeconds': timestamp }
+            }]
+        }
+        for i, row in df.iterrows()
+    ]
+    return [entries[i:i+batch_size] for i in range(0, len(entries), batch_size)]
+
+
+def create_df(num_properties):
+    rng = np.random.default_rng()
+    return pd.DataFrame({
+        'assetId': [str(uuid.uuid4()) for _ in range(num_properties)],
+        'propertyId': [str(uuid.uuid4()) for _ in range(num_properties)],
+        'value': rng.uniform(low=1, high=100, size=num_properties),
+    })
+
+
+def column_wise_batches(df, timestamp):
+    return iter_entry_batches(df, df['value'].to_numpy(), timestamp)
+
+
+def entries_per_sec(func, df):
+    timestamp = int(time.time())
+    start = time.perf_counter()
+    num_entries = sum(len(batch) for batch in func(df, timestamp))
+    return num_entries / (time.perf_counter() - start)
+
+
+if __name__ == '__main__':
+    print(f"{'Properties':>10} {'iterrows (entries/s)':>22} {'column-wise (entries/s)':>25} {'Speedup':>8}")
+    for size in SIZES:
+        df = create_df(size)
+        old_rate = entries_per_sec(iterrows_batches, df)
+        new_rate = entries_per_sec(column_wise_batches, df)
+        print(f'{size:>10} {old_rate:>22,.0f} {new_rate:>25,.0f} {new_rate / old_rate:>7.1f}x')
@@ -25,11 +25,29 @@ meas_gen_function_name=$(echo "$cfn_output" | awk '/MeasurementGenLambdaName/ {p
 meas_gen_invoker_rule=$(echo "$cfn_output" | awk '/MeasurementGenInvokerRuleName/ {print $2}')
 bucket_name=$(echo "$cfn_output" | awk '/BucketName/ {print $2}')
 
-package_file='lambda-package.zip'
-zip $package_file gen_measurement.py
+# aiobotocore is not in the Lambda runtime or the AWS SDK for pandas layer, so it is bundled
+# into the package. It is resolved against the botocore version in the layer (which awswrangler
+# was built against), and botocore and its dependencies are left out so the layer's are used.
+# aiohttp and its dependencies have C extensions, so the wheels are for the Lambda runtime's
+# platform and Python version rather than this machine's
+package_file="$PWD/lambda-package.zip"
+package_dir=$(mktemp -d)
+layer_arn=$(aws lambda get-function-configuration --function-name $meas_gen_function_name --query 'Layers[0].Arn' --output text)
+layer_url=$(aws lambda get-layer-version-by-arn --arn $layer_arn --query 'Content.Location' --output text)
+curl --silent --output $package_dir/layer.zip "$layer_url"
+botocore_version=$(unzip -Z1 $package_dir/layer.zip | sed -n 's|^python/botocore-\([0-9.]*\)\.dist-info/.*|\1|p' | head -1)
+rm $package_dir/layer.zip
+[[ -z "$botocore_version" ]] && { echo "Could not find the botocore version of layer $layer_arn"; exit 1; }
+echo "Bundling aiobotocore for botocore $botocore_version"
+pip install --quiet --target $package_dir \
+    --platform manylinux2014_x86_64 --implementation cp --python-version 3.12 --only-binary=:all: \
+    aiobotocore "botocore==$botocore_version"
+(cd $package_dir && rm -rf bin botocore* jmespath* dateutil python_dateutil* urllib3* six.py six-*)
+cp gen_measurement.py ../batch_put.py ../signal_models.py $package_dir
+(cd $package_dir && zip -q -r $package_file .)
 aws lambda update-function-code --function-name $meas_gen_function_name --zip-file "fileb://$package_file" > /dev/null
 echo 'Uploaded MeasurementGenerator to Lambda'
-rm $package_file
+rm -rf $package_file $package_dir
 
 echo 'Create your AssetModels and Assets, if not done already and write the'
 echo 'assetId/propertyId pairs to a CSV file (with a header row) and upload to S3:'
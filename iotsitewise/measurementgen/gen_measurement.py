@@ -1,3 +1,9 @@
+import argparse
+import asyncio
+import hashlib
+import io
+import json
+import multiprocessing
 import os
 import random
 from datetime import datetime
@@ -6,10 +12,20 @@ import boto3
 import awswrangler as wr
 import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from aiobotocore.session import get_session
 from botocore.exceptions import ClientError
 
+import signal_models
+from batch_put import AsyncBatchSender, sender_client_config
 
-VALUES_S3_KEY = 'property_values.csv'
+
+VALUES_S3_KEY = 'property_values.parquet'
+NUM_SHARDS = int(os.getenv('NUM_SHARDS', '1'))
+IDS_HASH_METADATA_KEY = b'ids_hash'
+NULL_DOUBLE_VALUE = { 'nullValue': { 'valueType': 'D' } }
+MAX_REQUESTS_IN_FLIGHT = int(os.getenv('MAX_REQUESTS_IN_FLIGHT', '32'))
 
 
 def load_asset_properties(asset_properties_path):
@@ -18,81 +34,232 @@ def load_asset_properties(asset_properties_path):
     return asset_properties
 
 
-def load_property_values(asset_properties, property_values_path):
-    if not wr.s3.does_object_exist(property_values_path):
+def select_shard(asset_properties, shard, num_shards):
+    # Each shard owns a contiguous range of the assetId hash space, so all properties
+    # of an asset are always generated by the same worker
+    if num_shards == 1:
+        return asset_properties
+    hashes = pd.util.hash_pandas_object(asset_properties['assetId'], index=False).to_numpy()
+    shards = ((hashes >> np.uint64(32)) * np.uint64(num_shards)) >> np.uint64(32)
+    df = asset_properties[shards == shard].reset_index(drop=True)
+    print(f'Shard {shard + 1}/{num_shards} has {len(df)} asset/property IDs')
+    return df
+
+
+def values_s3_key(shard, num_shards):
+    if num_shards == 1:
+        return VALUES_S3_KEY
+    name, ext = os.path.splitext(VALUES_S3_KEY)
+    return f'{name}-{shard + 1}-of-{num_shards}{ext}'
+
+
+def hash_ids(asset_properties):
+    hashes = pd.util.hash_pandas_object(asset_properties[['assetId', 'propertyId']], index=False)
+    return hashlib.sha256(hashes.to_numpy().tobytes()).hexdigest()
+
+
+def load_property_values(s3, ids_hash, s3_bucket, s3_key):
+    try:
+        response = s3.get_object(Bucket=s3_bucket, Key=s3_key)
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'NoSuchKey':
+            raise
         print('No property values file found')
         return None
 
     print('Found property values file')
-    df = wr.s3.read_csv(property_values_path)
-    ap_keys = set(zip(asset_properties['assetId'], asset_properties['propertyId']))
-    df_keys = set(zip(df['assetId'], df['propertyId']))
-    if ap_keys != df_keys:
+    # The ID columns are only needed when the asset/property IDs have changed, which
+    # is detected by the hash of the ID columns stored in the file metadata
+    parquet_file = pq.ParquetFile(io.BytesIO(response['Body'].read()))
+    metadata = parquet_file.schema_arrow.metadata or {}
+    if metadata.get(IDS_HASH_METADATA_KEY, b'').decode() != ids_hash:
         print('Asset/property IDs mismatch in property values file')
         return None
 
+    return parquet_file.read(columns=['value'])['value'].to_numpy()
+
+
+def save_property_values(s3, df, ids_hash, s3_bucket, s3_key):
+    table = pa.table({
+        'assetId': pa.array(df['assetId']).dictionary_encode(),
+        'propertyId': pa.array(df['propertyId']).dictionary_encode(),
+        'value': pa.array(df['value'], type=pa.float64()),
+    })
+    table = table.replace_schema_metadata({IDS_HASH_METADATA_KEY: ids_hash.encode()})
+    buffer = io.BytesIO()
+    pq.write_table(table, buffer)
+    s3.put_object(Bucket=s3_bucket, Key=s3_key, Body=buffer.getvalue())
+    print(f"Uploaded values file to s3://{s3_bucket}/{s3_key}")
+
+
+def generate_values(asset_properties, property_values, timestamp):
+    rng = np.random.default_rng()
+    print('Generating init values' if property_values is None else 'Generating next values')
+    df = asset_properties.copy()
+    df['value'] = signal_models.generate(asset_properties, property_values, [timestamp], rng)[:, 0]
     return df
 
 
-def generate_values(asset_properties, property_values, property_values_path):
+def to_property_value(value, timestamp):
+    # Dropped out values (NaN) are sent as null values
+    if value != value:
+        return { 'value': NULL_DOUBLE_VALUE, 'timestamp': timestamp, 'quality': 'BAD' }
+    return { 'value': { 'doubleValue': value }, 'timestamp': timestamp }
+
+
+def iter_entry_batches(df, values, timestamp, batch_size=10):
+    # Converting whole columns to lists up front is much faster than df.iterrows(), and
+    # the batches are built lazily so the full list of entries is never held in memory
+    asset_ids = df['assetId'].to_numpy().tolist()
+    property_ids = df['propertyId'].to_numpy().tolist()
+    values = values.tolist()
+    timestamp = { 'timeInSeconds': timestamp }
+    entry_ids = [str(i) for i in range(batch_size)]
+    for start in range(0, len(values), batch_size):
+        end = start + batch_size
+        yield [
+            {
+                'entryId': entry_id,
+                'assetId': asset_id,
+                'propertyId': property_id,
+                'propertyValues': [to_property_value(value, timestamp)]
+            }
+            for entry_id, asset_id, property_id, value in zip(
+                entry_ids, asset_ids[start:end], property_ids[start:end], values[start:end])
+        ]
+
+
+def generate_backfill_values(asset_properties, property_values, timestamps):
+    # Generates the (properties x ticks) matrix for every property and tick at once
     rng = np.random.default_rng()
-    if property_values is None:
-        print('Generating init values')
-        df = asset_properties.copy()
-        df['value'] = rng.uniform(low=1, high=100, size=len(df))
-    else:
-        print('Applying random walk')
-        df = property_values
-        df['value'] += rng.normal(0, 1, size=len(df))
+    print(f'Generating values for {len(timestamps)} ticks')
+    return signal_models.generate(asset_properties, property_values, timestamps, rng)
 
-    wr.s3.to_csv(df, property_values_path, index=False)
-    print(f"Uploaded values file to {property_values_path}")
-    return df
 
+def iter_backfill_batches(df, values, timestamps, batch_size=10, values_per_entry=10):
+    # Each entry holds up to 10 consecutive values of the same property
+    asset_ids = df['assetId'].to_numpy().tolist()
+    property_ids = df['propertyId'].to_numpy().tolist()
+    timestamps = [{ 'timeInSeconds': ts } for ts in timestamps.tolist()]
+    batch = []
+    # One property's values are converted to Python floats at a time, as the batches are taken
+    for asset_id, property_id, row in zip(asset_ids, property_ids, values):
+        property_values = row.tolist()
+        for start in range(0, len(timestamps), values_per_entry):
+            end = start + values_per_entry
+            batch.append({
+                'entryId': str(len(batch)),
+                'assetId': asset_id,
+                'propertyId': property_id,
+                'propertyValues': [
+                    to_property_value(value, timestamp)
+                    for value, timestamp in zip(property_values[start:end], timestamps[start:end])
+                ]
+            })
+            if len(batch) == batch_size:
+                yield batch
+                batch = []
+    if batch:
+        yield batch
 
-def chunk_list(lst, n):
-    return [lst[i:i+n] for i in range(0, len(lst), n)]
 
+async def send_batches(batches):
+    session = get_session()
+    async with session.create_client('iotsitewise', config=sender_client_config(MAX_REQUESTS_IN_FLIGHT)) as sitewise:
+        sender = AsyncBatchSender(sitewise, max_window=MAX_REQUESTS_IN_FLIGHT)
+        error_entries = await sender.send_all(batches)
 
-def send_values(sitewise, df, dt_now):
-    timestamp = int(dt_now.timestamp())
-    entries = [
-        {
-            'entryId': str(i),
-            'assetId': row['assetId'],
-            'propertyId': row['propertyId'],
-            'propertyValues': [{
-                'value': { 'doubleValue': row['value'] },
-                'timestamp': { 'timeInSeconds': timestamp }
-            }]
-        }
-        for i, row in df.iterrows()
-    ]
+    error_messages = '\n'.join([
+        '{} {}'.format(error['errorCode'], error['errorMessage'])
+        for entry in error_entries
+        for error in entry.get('errors', [])
+    ])
+    if error_messages:
+        raise RuntimeError(f'Failed sending data to SiteWise: {error_messages}')
 
-    for batch in chunk_list(entries, 10):
-        print(f'Sending batch with {len(batch)} entries to Sitewise')
-        response = sitewise.batch_put_asset_property_value(entries=batch)
-        print('Response:', response)
 
-        error_messages = '\n'.join([
-            '{} {}'.format(error['errorCode'], error['errorMessage'])
-            for entry in response.get('errorEntries', [])
-            for error in entry.get('errors', [])
-        ])
-        if error_messages:
-            raise RuntimeError(f'Failed sending data to SiteWise: {error_messages}')
+async def send_values(df, values, dt_now):
+    await send_batches(iter_entry_batches(df, values, int(dt_now.timestamp())))
 
 
-def handler(event, context):
-    dt_now = datetime.fromisoformat(event['time']).replace(second=0, microsecond=0)
+def run_shard(dt_now, shard, num_shards, dt_end=None):
     s3_bucket = os.environ['DATA_S3_BUCKET']
     s3_key = os.environ['ASSET_PROPERTY_ID_S3_KEY']
     asset_properties_path = f's3://{s3_bucket}/{s3_key}'
-    property_values_path = f's3://{s3_bucket}/{VALUES_S3_KEY}'
+    property_values_key = values_s3_key(shard, num_shards)
+
+    s3 = boto3.client('s3')
+
+    asset_properties = select_shard(load_asset_properties(asset_properties_path), shard, num_shards)
+    ids_hash = hash_ids(asset_properties)
+    property_values = load_property_values(s3, ids_hash, s3_bucket, property_values_key)
+    rng = np.random.default_rng()
+    if dt_end is None:
+        df = generate_values(asset_properties, property_values, int(dt_now.timestamp()))
+        save_property_values(s3, df, ids_hash, s3_bucket, property_values_key)
+        values = signal_models.apply_dropout(asset_properties, df['value'].to_numpy()[:, np.newaxis], rng)
+        asyncio.run(send_values(df, values[:, 0], dt_now))
+    else:
+        # Backfill every minute in [dt_now, dt_end), continuing the random walk from the
+        # saved state and saving the last values so live generation carries on from there
+        timestamps = np.arange(int(dt_now.timestamp()), int(dt_end.timestamp()), 60)
+        if len(timestamps) == 0:
+            print('Nothing to backfill')
+            return
+        values = generate_backfill_values(asset_properties, property_values, timestamps)
+        df = asset_properties.copy()
+        df['value'] = values[:, -1]
+        save_property_values(s3, df, ids_hash, s3_bucket, property_values_key)
+        values = signal_models.apply_dropout(asset_properties, values, rng)
+        asyncio.run(send_batches(iter_backfill_batches(df, values, timestamps)))
+
+
+def invoke_shards(function_name, event, num_shards):
+    lambda_client = boto3.client('lambda')
+    for shard in range(num_shards):
+        payload = {**event, 'shard': shard, 'num_shards': num_shards}
+        lambda_client.invoke(FunctionName=function_name,
+                             InvocationType='Event',
+                             Payload=json.dumps(payload))
+    print(f'Invoked {num_shards} shard workers')
+
 
-    sitewise = boto3.client('iotsitewise')
+def to_minute(dt_str):
+    return datetime.fromisoformat(dt_str).replace(second=0, microsecond=0)
 
-    asset_properties = load_asset_properties(asset_properties_path)
-    property_values = load_property_values(asset_properties, property_values_path)
-    df = generate_values(asset_properties, property_values, property_values_path)
-    send_values(sitewise, df, dt_now)
+
+def handler(event, context):
+    # Backfill events look like {"backfill": {"start": <ISO 8601>, "end": <ISO 8601>}}
+    if 'backfill' in event:
+        dt_now = to_minute(event['backfill']['start'])
+        dt_end = to_minute(event['backfill']['end'])
+    else:
+        dt_now = to_minute(event['time'])
+        dt_end = None
+
+    if 'shard' in event:
+        run_shard(dt_now, event['shard'], event['num_shards'], dt_end)
+    elif NUM_SHARDS > 1:
+        invoke_shards(context.function_name, event, NUM_SHARDS)
+    else:
+        run_shard(dt_now, 0, 1, dt_end)
+
+
+if __name__ == '__main__':
+    # Runs the shard workers as local processes, e.g.
+    #   DATA_S3_BUCKET=<bucket> ASSET_PROPERTY_ID_S3_KEY=<key> python gen_measurement.py --shards 4
+    parser = argparse.ArgumentParser(description='Generate measurements using local worker processes')
+    parser.add_argument('--shards', type=int, default=NUM_SHARDS, help='Number of shards (worker processes)')
+    parser.add_argument('--time', help='ISO 8601 timestamp to generate values for (default: now)')
+    parser.add_argument('--start', help='Backfill values starting from this ISO 8601 timestamp')
+    parser.add_argument('--end', help='Backfill values up to (not including) this ISO 8601 timestamp')
+    args = parser.parse_args()
+
+    if args.start:
+        dt_now = to_minute(args.start)
+        dt_end = to_minute(args.end) if args.end else datetime.now().astimezone().replace(second=0, microsecond=0)
+    else:
+        dt_now = to_minute(args.time) if args.time else datetime.now().astimezone().replace(second=0, microsecond=0)
+        dt_end = None
+    with multiprocessing.Pool(args.shards) as pool:
+        pool.starmap(run_shard, [(dt_now, shard, args.shards, dt_end) for shard in range(args.shards)])
@@ -0,0 +1,69 @@
+import copy
+import math
+import time
+
+
+# Batch size used until there's a latency to go by (or when running without a Lambda context)
+DEFAULT_BATCH_SIZE = 500
+MIN_BATCH_SIZE = 10
+MAX_BATCH_SIZE = 5000
+# No new models are scheduled this close (seconds) to the Lambda timeout
+SAFETY_MARGIN_S = 60
+# The models still being processed are stopped this close (seconds) to the Lambda timeout, so
+# there's time left to save the progress
+CANCEL_MARGIN_S = 10
+# Weight of the latest invocation in the latency moving average
+LATENCY_EWMA_ALPHA = 0.3
+
+
+class DeadlineReached(Exception):
+    pass
+
+
+class Deadline:
+    def __init__(self, remaining_time_s, margin_s=SAFETY_MARGIN_S):
+        # Time of the Lambda timeout
+        self.end = math.inf if remaining_time_s is None else time.monotonic() + remaining_time_s
+        self.stop_at = self.end - margin_s
+
+    @classmethod
+    def from_context(cls, context):
+        return cls(context.get_remaining_time_in_millis() / 1000 if context else None)
+
+    def with_margin(self, margin_s):
+        # The same Lambda timeout, with a different margin
+        deadline = copy.copy(self)
+        deadline.stop_at = self.end - margin_s
+        return deadline
+
+    def time_left(self):
+        return self.stop_at - time.monotonic()
+
+    def timeout(self):
+        # time_left() as a timeout for asyncio.wait_for(), None when there's no Lambda timeout
+        return None if self.end == math.inf else max(0, self.time_left())
+
+    def passed(self):
+        return time.monotonic() >= self.stop_at
+
+
+def batch_size(config, latency_key, deadline, parallelism):
+    """
+    Number of models that can be processed before the deadline, given the average time
+    (config[latency_key], in seconds) one model takes with `parallelism` models at a time
+    """
+    latency = config.get(latency_key)
+    if not latency or deadline.stop_at == math.inf:
+        return DEFAULT_BATCH_SIZE
+    num_models = int(max(0, deadline.time_left()) / float(latency) * parallelism)
+    return max(MIN_BATCH_SIZE, min(MAX_BATCH_SIZE, num_models))
+
+
+def update_latency(config, latency_key, latencies):
+    # Keeps an exponentially weighted moving average of the per-model latency in the config item
+    if not latencies:
+        return
+    latest = sum(latencies) / len(latencies)
+    previous = config.get(latency_key)
+    latency = latest if previous is None else (1 - LATENCY_EWMA_ALPHA) * float(previous) + LATENCY_EWMA_ALPHA * latest
+    config[latency_key] = round(latency, 3)
@@ -1,35 +1,31 @@
 import asyncio
+import itertools
 import os
 import random
+import time
 
 import boto3
-import json
 from aiobotocore.session import get_session
 from botocore.exceptions import ClientError
 from dynamodb_json import json_util as ddbjson
 
+from loadtest.batchsize import CANCEL_MARGIN_S, Deadline, DeadlineReached, batch_size, update_latency
+from loadtest.modelstate import get_model_state
+from loadtest.statuspoller import StatusPoller
+
 
 COMPLETED_MODELS_TABLE = os.environ['COMPLETED_MODELS_TABLE']
 MODELS_TABLE = os.environ['MODELS_TABLE']
 S3_BUCKET = os.environ['DATA_BUCKET']
 MODELS_FILE_KEY = os.environ['MODELS_FILE_KEY']
 HIERARCHY_PREFIX = 'hierarchy'
-MAX_MODELS_CREATE = 500
+# Config item attribute with the moving average of the time (seconds) to create a model
+CREATE_LATENCY_KEY = 'create_latency_s'
 MAX_MODELS_PARALLEL_CREATE = 10
+MAX_BATCH_GET_KEYS = 100
 TEMPERATURE_METRIC_NAME = 'temperature_avg'
 
 
-async def get_models_file(s3):
-    response = await s3.get_object(Bucket=S3_BUCKET, Key=MODELS_FILE_KEY)
-    async with response['Body'] as stream:
-        file_content = await stream.read()
-    return json.loads(file_content.decode('utf-8'))
-
-
-async def save_models_file(s3, models):
-    await s3.put_object(Body=json.dumps(models), Bucket=S3_BUCKET, Key=MODELS_FILE_KEY, ContentType='application/json')
-
-
 async def save_new_model_ddb(ddb, new_model):
     model_group = {
         'group': new_model['group'],
@@ -64,6 +60,46 @@ async def get_model(ddb, model_name):
         return None
 
 
+class ModelCache:
+    """
+    Models of the MODELS_TABLE, looked up for the whole batch of an invocation with
+    BatchGetItem. Names that aren't in the table are cached as None.
+    """
+
+    def __init__(self, ddb):
+        self.ddb = ddb
+        self.models = {}
+
+    async def _batch_get(self, names):
+        request_items = {MODELS_TABLE: {'Keys': [ddbjson.dumps({'name': name}, as_dict=True) for name in names]}}
+        attempt = 0
+        while request_items:
+            if attempt:
+                await asyncio.sleep(random.uniform(0, 0.1 * 2**attempt))
+            response = await self.ddb.batch_get_item(RequestItems=request_items)
+            for item in response['Responses'].get(MODELS_TABLE, []):
+                model = ddbjson.loads(item, as_dict=True)
+                self.models[model['name']] = model
+            request_items = response.get('UnprocessedKeys')
+            attempt += 1
+
+    async def warm(self, names):
+        names = [name for name in dict.fromkeys(names) if name not in self.models]
+        await asyncio.gather(*(self._batch_get(names[i:i+MAX_BATCH_GET_KEYS])
+                               for i in range(0, len(names), MAX_BATCH_GET_KEYS)))
+        for name in names:
+            self.models.setdefault(name, None)
+        print(f'Loaded {sum(self.models[name] is not None for name in names)} of {len(names)} models from DDB')
+
+    async def get(self, name):
+        if name not in self.models:
+            self.models[name] = await get_model(self.ddb, name)
+        return self.models[name]
+
+    def put(self, model):
+        self.models[model['name']] = model
+
+
 def create_leaf_model_spec(name):
     return {
         'assetModelName': name,
@@ -134,31 +170,18 @@ def create_parent_model_spec(name, child_models):
     }
 
 
-async def wait_for_model_active(sitewise, asset_model_id):
-    for _ in range(0, 300):
-        sw_model = await sitewise.describe_asset_model(assetModelId=asset_model_id)
-        status = sw_model['assetModelStatus']
-        if status['state'] == 'ACTIVE':
-            return
-        await asyncio.sleep(1)
-    raise Exception(f'Failed to create AssetModel {asset_model_id} final status: {status}')
-
-
 def get_prop_id(asset_model, prop_name):
     for property in asset_model.get('assetModelProperties', []):
         if property['name'] == prop_name:
             return property['id']
 
 
-async def _create_sitewise_model(sitewise, ddb, new_model):
+async def _create_sitewise_model(sitewise, ddb, model_cache, new_model):
     model_name = new_model['name']
     if new_model['is_leaf_node']:
         model_spec = create_leaf_model_spec(model_name)
     else:
-        child_models = []
-        for child_name in new_model['children']:
-            child = await get_model(ddb, child_name)
-            child_models.append(child)
+        child_models = [await model_cache.get(child_name) for child_name in new_model['children']]
         model_spec = create_parent_model_spec(model_name, child_models)
 
     await asyncio.sleep(random.uniform(0.1, 1))
@@ -171,10 +194,16 @@ async def _create_sitewise_model(sitewise, ddb, new_model):
             response['ResponseMetadata']['RequestId']))
 
         response = await sitewise.describe_asset_model(assetModelId=model_id)
-        new_model['sw_id'] = model_id
-        new_model['metric_id'] = get_prop_id(response, TEMPERATURE_METRIC_NAME)
-        await save_new_model_ddb(ddb, new_model)
-        return model_id
+        model = {
+            'group': new_model['group'],
+            'name': model_name,
+            'sw_id': model_id,
+            'children': new_model['children'],
+            'metric_id': get_prop_id(response, TEMPERATURE_METRIC_NAME),
+        }
+        await save_new_model_ddb(ddb, model)
+        model_cache.put({key: model[key] for key in ('name', 'sw_id', 'children', 'metric_id')})
+        return model
     except ClientError as e:
         print('Failed to create/describe AssetModel. Name={}, RequestId={}, Error={} {}'.format(
             model_name,
@@ -184,45 +213,110 @@ async def _create_sitewise_model(sitewise, ddb, new_model):
         raise
 
 
-async def create_sitewise_model(semaphore, sitewise, ddb, new_model):
+async def create_sitewise_model(semaphore, sitewise, ddb, poller, model_cache, new_model, deadline):
+    # Returns how long the model took to create and become ACTIVE, or None if it already existed
     async with semaphore:
+        if deadline.passed():
+            raise DeadlineReached()
+        start = time.monotonic()
         model_name = new_model['name']
-        model = await get_model(ddb, model_name)
-        if model is None:
-            model_id = await _create_sitewise_model(sitewise, ddb, new_model)
-        else:
-            model_id = model['sw_id']
-
-        await wait_for_model_active(sitewise, model_id)
+        model = await model_cache.get(model_name)
+        existed = model is not None
+        if not existed:
+            model = await _create_sitewise_model(sitewise, ddb, model_cache, new_model)
+
+        await poller.wait_active(model['sw_id'])
+        # The models file only gets the IDs of ACTIVE models, so a model that's still being
+        # created when the invocation stops is waited for again by the next one
+        new_model['sw_id'] = model['sw_id']
+        new_model['metric_id'] = model.get('metric_id')
         print(f'AssetModel {model_name} created')
+        return None if existed else time.monotonic() - start
+
+
+async def create_when_ready(semaphore, sitewise, ddb, poller, model_cache, new_model, deadline, created, changes, latencies):
+    # A model can be created once its own children are ACTIVE. It only takes a slot in the
+    # semaphore after that, so models waiting for their children don't hold up ready models.
+    # Models that would start too close to the deadline (and their parents) are left for the
+    # next invocation
+    try:
+        await asyncio.gather(*(created[child_name] for child_name in new_model['children']))
+        latency = await create_sitewise_model(semaphore, sitewise, ddb, poller, model_cache, new_model, deadline)
+        if latency is not None:
+            latencies.append(latency)
+        changes[new_model['name']] = {'sw_id': new_model['sw_id'], 'metric_id': new_model.get('metric_id')}
+        created[new_model['name']].set_result(new_model['sw_id'])
+    except Exception as e:
+        created[new_model['name']].set_exception(e)
+        raise
 
 
-async def create_models(sitewise, s3, ddb):
-    models = await get_models_file(s3)
+async def create_models(sitewise, s3, ddb, deadline):
+    model_state = get_model_state(s3, S3_BUCKET, MODELS_FILE_KEY)
+    models = await model_state.load()
     config = await get_config(ddb)
-    current_group = config['current_group']
-    next_batch = [m for m in models['models'] if m['group'] == current_group and m['sw_id'] is None]
-    total_model_count = len(next_batch)
-    next_batch = next_batch[0:MAX_MODELS_CREATE]
+
+    # Children are always in a lower group than their parents, so the first models in group
+    # order include the children (or already created models) of every parent among them
+    pending = sorted((m for m in models['models'] if m['sw_id'] is None), key=lambda m: m['group'])
+    num_models = batch_size(config, CREATE_LATENCY_KEY, deadline, MAX_MODELS_PARALLEL_CREATE)
+    next_batch = pending[0:num_models]
+    print(f'Creating up to {len(next_batch)} of {len(pending)} pending models')
+
+    # Every model of the batch, and every child needed for its parents' specs, in one pass
+    model_cache = ModelCache(ddb)
+    await model_cache.warm(itertools.chain.from_iterable([m['name'], *m['children']] for m in next_batch))
+
+    loop = asyncio.get_running_loop()
+    created = {}
+    changes = {}
+    latencies = []
+    for model in models['models']:
+        created[model['name']] = loop.create_future()
+        if model['sw_id'] is not None:
+            created[model['name']].set_result(model['sw_id'])
 
     tasks = []
     semaphore = asyncio.Semaphore(MAX_MODELS_PARALLEL_CREATE)
+    # No new models are created after the deadline, and the ones still waiting to become ACTIVE
+    # are stopped at the cancel deadline, so the changes are saved before the Lambda timeout
+    cancel_deadline = deadline.with_margin(CANCEL_MARGIN_S)
     try:
-        for new_model in next_batch:
-            tasks.append(asyncio.ensure_future(create_sitewise_model(semaphore, sitewise, ddb, new_model)))
-        await asyncio.gather(*tasks)
+        async with StatusPoller(sitewise) as poller:
+            for new_model in next_batch:
+                tasks.append(asyncio.ensure_future(
+                    create_when_ready(semaphore, sitewise, ddb, poller, model_cache, new_model, deadline,
+                                      created, changes, latencies)))
+            try:
+                # By then, the models started before the deadline have their sw_id saved in
+                # MODELS_TABLE, so the next invocation waits for them to become ACTIVE instead of
+                # creating them again
+                await asyncio.wait_for(asyncio.gather(*tasks, return_exceptions=True),
+                                       timeout=cancel_deadline.timeout())
+            except asyncio.TimeoutError:
+                print('Stopped the models still being created before the Lambda timeout')
+            finally:
+                for task in tasks:
+                    task.cancel()
+        errors = [task.exception() for task in tasks if task.done() and not task.cancelled()]
+        errors = [e for e in errors if e is not None and not isinstance(e, DeadlineReached)]
+        if errors:
+            raise errors[0]
     finally:
-        await save_models_file(s3, models)
-
-    if len(next_batch) < total_model_count:
-        return { 'finished': False }
-    else:
-        if next((m for m in models['models'] if m['group'] == current_group + 1), None) is not None:
-            config['current_group'] += 1
+        # Only the models created by this invocation are written
+        await model_state.save(changes)
+        # The models are deleted from current_group down, so it has to cover every model created so far
+        max_group = max((m['group'] for m in models['models'] if m['sw_id'] is not None), default=0)
+        if max_group != config['current_group'] or latencies:
+            config['current_group'] = max_group
+            update_latency(config, CREATE_LATENCY_KEY, latencies)
             await ddb.put_item(TableName=MODELS_TABLE, Item=ddbjson.dumps(config, as_dict=True))
-            return { 'finished': False }
-        else:
-            return { 'finished': True }
+        # Don't warn about failures of parents whose children failed, they were already raised
+        for future in created.values():
+            if future.done() and not future.cancelled():
+                future.exception()
+
+    return { 'finished': all(m['sw_id'] is not None for m in models['models']) }
 
 
 async def async_handler(event, context):
@@ -232,7 +326,7 @@ async def async_handler(event, context):
     async with (session.create_client('iotsitewise') as sitewise,
                 session.create_client('s3') as s3,
                 session.create_client('dynamodb', endpoint_url=ddb_endpoint) as ddb):
-        return await create_models(sitewise, s3, ddb)
+        return await create_models(sitewise, s3, ddb, Deadline.from_context(context))
 
 
 def handler(event, context):
@@ -1,39 +1,55 @@
 import asyncio
+import contextlib
 import os
 import random
+import time
 
 import boto3
 from aiobotocore.session import get_session
 from botocore.exceptions import ClientError
 from dynamodb_json import json_util as ddbjson
 
+from loadtest.batchsize import CANCEL_MARGIN_S, Deadline, batch_size, update_latency
+from loadtest.statuspoller import StatusPoller
+
 
 COMPLETED_MODELS_TABLE = os.environ['COMPLETED_MODELS_TABLE']
 MODELS_TABLE = os.environ['MODELS_TABLE']
-MAX_MODELS_DELETE = 500
 MAX_MODELS_PARALLEL_DELETE = 10
+# Config item attribute with the moving average of the time (seconds) to delete a model
+DELETE_LATENCY_KEY = 'delete_latency_s'
 
 
-async def scan_completed_models(ddb, group, max_results):
+async def query_completed_models(ddb, group, max_results):
+    # group is the partition key, so only the current group's items are read
     params = {
         'TableName': COMPLETED_MODELS_TABLE,
-        'FilterExpression': '#group = :g',
+        'KeyConditionExpression': '#group = :g',
+        'ProjectionExpression': '#name, sw_id',
         'ExpressionAttributeValues': { ':g': { 'N': str(group) } },
-        'ExpressionAttributeNames': { '#group': 'group' }
+        'ExpressionAttributeNames': { '#group': 'group', '#name': 'name' }
     }
     count = 0
-    while True:
-        response = await ddb.scan(**params)
-        for item in response.get('Items', []):
-            yield ddbjson.loads(item, as_dict=True)
-            count += 1
-            if count == max_results:
-                return
-        last_evaluated_key = response.get('LastEvaluatedKey')
-        if last_evaluated_key:
-            params['ExclusiveStartKey'] = last_evaluated_key
-        else:
-            break
+    next_page = asyncio.ensure_future(ddb.query(**params))
+    try:
+        while next_page:
+            response = await next_page
+            last_evaluated_key = response.get('LastEvaluatedKey')
+            # Fetch the next page while the models of this page are being deleted
+            if last_evaluated_key and count + response['Count'] < max_results:
+                next_page = asyncio.ensure_future(ddb.query(**params, ExclusiveStartKey=last_evaluated_key))
+            else:
+                next_page = None
+            for item in response.get('Items', []):
+                yield { 'group': group, **ddbjson.loads(item, as_dict=True) }
+                count += 1
+                if count == max_results:
+                    return
+    finally:
+        # Also runs when the caller stops early (or is cancelled), so the prefetch doesn't
+        # outlive the generator
+        if next_page:
+            next_page.cancel()
 
 
 async def more_models_to_delete(ddb, group):
@@ -65,68 +81,106 @@ async def get_config(ddb):
     return ddbjson.loads(response['Item'], as_dict=True)
 
 
-async def wait_for_model_deleted(sitewise, asset_model_id):
-    for _ in range(0, 180):
-        try:
-            sw_model = await sitewise.describe_asset_model(assetModelId=asset_model_id)
-            status = sw_model['assetModelStatus']
-            if status['state'] == 'FAILED':
+async def delete_sitewise_model(sitewise, ddb, poller, new_event):
+    model_name = new_event['name']
+    model_id = new_event['sw_id']
+
+    await asyncio.sleep(random.uniform(0.1, 1))
+    try:
+        response = await sitewise.delete_asset_model(assetModelId=model_id)
+        print('Deleting AssetModel. Name={}, ID={}, RequestId={}'.format(
+            model_name,
+            model_id,
+            response['ResponseMetadata']['RequestId']))
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ResourceNotFoundException':
+            print('Failed to delete AssetModel. Name={}, ID={}, RequestId={}, Error={} {}'.format(
+                model_name,
+                model_id,
+                e.response['ResponseMetadata']['RequestId'],
+                e.response['Error']['Code'],
+                e.response['Error']['Message']))
+            raise
+
+    await poller.wait_deleted(model_id)
+    await mark_model_deleted(ddb, new_event)
+    print(f'Model {model_name} deleted')
+
+
+async def queue_models(queue, ddb, group, max_models, deadline, num_workers):
+    # put() waits while the queue is full, so the query only reads ahead of the workers by a
+    # little
+    # aclosing() finishes the query generator (and its prefetch) as soon as the loop exits
+    async with contextlib.aclosing(query_completed_models(ddb, group, max_models)) as new_events:
+        async for new_event in new_events:
+            if deadline.passed():
                 break
-            await asyncio.sleep(1)
-        except ClientError as e:
-            if e.response['Error']['Code'] == 'ResourceNotFoundException':
-                return
-            else:
-                raise
-    raise RuntimeError(f'Failed to delete AssetModel {asset_model_id} final status: {status}')
+            await queue.put(new_event)
+    for _ in range(num_workers):
+        await queue.put(None)
 
 
-async def delete_sitewise_model(semaphore, sitewise, ddb, new_event):
-    async with semaphore:
-        model_name = new_event['name']
-        model_id = new_event['sw_id']
-
-        await asyncio.sleep(random.uniform(0.1, 1))
+async def delete_worker(queue, sitewise, ddb, poller, deadline, stats):
+    while True:
+        new_event = await queue.get()
+        if new_event is None:
+            return
+        # Near the deadline, the remaining models are left for the next invocation
+        if deadline.passed():
+            continue
         try:
-            response = await sitewise.delete_asset_model(assetModelId=model_id)
-            print('Deleting AssetModel. Name={}, ID={}, RequestId={}'.format(
-                model_name,
-                model_id,
-                response['ResponseMetadata']['RequestId']))
-        except ClientError as e:
-            if e.response['Error']['Code'] != 'ResourceNotFoundException':
-                print('Failed to delete AssetModel. Name={}, ID={}, RequestId={}, Error={} {}'.format(
-                    model_name,
-                    model_id,
-                    e.response['ResponseMetadata']['RequestId'],
-                    e.response['Error']['Code'],
-                    e.response['Error']['Message']))
-                raise
-
-        await wait_for_model_deleted(sitewise, model_id)
-        await mark_model_deleted(ddb, new_event)
-        print(f'Model {model_name} deleted')
-
-
-async def delete_models(sitewise, ddb):
+            start = time.monotonic()
+            await delete_sitewise_model(sitewise, ddb, poller, new_event)
+            stats['latencies'].append(time.monotonic() - start)
+        except Exception as e:
+            print(f'Failed to delete model {new_event["name"]}: {e}')
+            stats['failed'] += 1
+
+
+async def delete_models(sitewise, ddb, deadline):
     config = await get_config(ddb)
     current_group = config['current_group']
 
-    tasks = []
-    semaphore = asyncio.Semaphore(MAX_MODELS_PARALLEL_DELETE)
-    async for new_event in scan_completed_models(ddb, current_group, MAX_MODELS_DELETE):
-        tasks.append(asyncio.ensure_future(delete_sitewise_model(semaphore, sitewise, ddb, new_event)))
-    await asyncio.gather(*tasks)
-
-    if await more_models_to_delete(ddb, current_group):
-        return { 'finished': False }
-    else:
+    start = time.monotonic()
+    # No new deletions are started after the deadline, and the ones still waiting for their
+    # model to be deleted are stopped at the cancel deadline
+    cancel_deadline = deadline.with_margin(CANCEL_MARGIN_S)
+    num_models = batch_size(config, DELETE_LATENCY_KEY, deadline, MAX_MODELS_PARALLEL_DELETE)
+    print(f'Deleting up to {num_models} models of group {current_group}')
+
+    stats = { 'latencies': [], 'failed': 0 }
+    queue = asyncio.Queue(maxsize=2 * MAX_MODELS_PARALLEL_DELETE)
+    async with StatusPoller(sitewise) as poller:
+        tasks = [asyncio.ensure_future(
+            queue_models(queue, ddb, current_group, num_models, deadline, MAX_MODELS_PARALLEL_DELETE))]
+        tasks.extend(asyncio.ensure_future(delete_worker(queue, sitewise, ddb, poller, deadline, stats))
+                     for _ in range(MAX_MODELS_PARALLEL_DELETE))
+        try:
+            # A model whose deletion is cancelled is deleted again (or just marked deleted) by
+            # the next invocation
+            await asyncio.wait_for(asyncio.gather(*tasks), timeout=cancel_deadline.timeout())
+        except asyncio.TimeoutError:
+            print('Stopped the deletions still in progress before the Lambda timeout')
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    elapsed = time.monotonic() - start
+    num_deleted = len(stats['latencies'])
+    print(f'Deleted {num_deleted} models in {elapsed:0.1f}s ({num_deleted / elapsed:0.2f} models/s)')
+    update_latency(config, DELETE_LATENCY_KEY, stats['latencies'])
+    if stats['failed']:
+        await ddb.put_item(TableName=MODELS_TABLE, Item=ddbjson.dumps(config, as_dict=True))
+        raise RuntimeError(f"Failed to delete {stats['failed']} models")
+
+    finished = False
+    if not await more_models_to_delete(ddb, current_group):
         if current_group > 0:
             config['current_group'] -= 1
-            await ddb.put_item(TableName=MODELS_TABLE, Item=ddbjson.dumps(config, as_dict=True))
-            return { 'finished': False }
         else:
-            return { 'finished': True }
+            finished = True
+    await ddb.put_item(TableName=MODELS_TABLE, Item=ddbjson.dumps(config, as_dict=True))
+    return { 'finished': finished }
 
 
 async def async_handler(event, context):
@@ -135,7 +189,7 @@ async def async_handler(event, context):
     session = get_session()
     async with (session.create_client('iotsitewise') as sitewise,
                 session.create_client('dynamodb', endpoint_url=ddb_endpoint) as ddb):
-        return await delete_models(sitewise, ddb)
+        return await delete_models(sitewise, ddb, Deadline.from_context(context))
 
 
 def handler(event, context):
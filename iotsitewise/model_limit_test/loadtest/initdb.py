@@ -1,18 +1,22 @@
 import os
 import time
 from collections import deque
+from pathlib import Path
 
 import boto3
 import json
 from botocore.exceptions import ClientError
 from dynamodb_json import json_util as ddbjson
 
+from loadtest.modelstate import delta_prefix
+
 
 MODELS_TABLE = os.environ['MODELS_TABLE']
 DDB_ENDPOINT = os.getenv('DDB_ENDPOINT')
 S3_BUCKET = os.environ['DATA_BUCKET']
 MODELS_FILE_KEY = os.environ['MODELS_FILE_KEY']
 REGION = os.environ['AWS_DEFAULT_REGION']
+MODEL_STATE_DIR = os.getenv('MODEL_STATE_DIR')
 
 
 class Node:
@@ -110,6 +114,27 @@ def to_models_obj(tree):
     return models
 
 
+def save_models(s3, models):
+    # Writes the initial models file, removing the change deltas of any previous test run
+    if MODEL_STATE_DIR:
+        models_file = Path(MODEL_STATE_DIR) / MODELS_FILE_KEY
+        models_file.parent.mkdir(parents=True, exist_ok=True)
+        models_file.write_text(json.dumps(models))
+        delta_dir = Path(MODEL_STATE_DIR) / delta_prefix(MODELS_FILE_KEY)
+        for delta_file in delta_dir.glob('*.json'):
+            delta_file.unlink()
+        print(f'Updated file {models_file}')
+        return
+
+    s3.put_object(Body=json.dumps(models), Bucket=S3_BUCKET, Key=MODELS_FILE_KEY , ContentType='application/json')
+    paginator = s3.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=S3_BUCKET, Prefix=delta_prefix(MODELS_FILE_KEY)):
+        if page.get('Contents'):
+            s3.delete_objects(Bucket=S3_BUCKET, Delete={
+                'Objects': [{'Key': obj['Key']} for obj in page['Contents']], 'Quiet': True})
+    print(f'Updated file s3://{S3_BUCKET}/{MODELS_FILE_KEY}')
+
+
 def handler(event, context):
     prefix = event['prefix']
     num_models = event['num_models']
@@ -133,8 +158,7 @@ def handler(event, context):
         raise RuntimeError(f'Invalid tree type. Event: {event}')
 
     models = to_models_obj(tree)
-    s3.put_object(Body=json.dumps(models), Bucket=S3_BUCKET, Key=MODELS_FILE_KEY , ContentType='application/json')
-    print(f'Updated file s3://{S3_BUCKET}/{MODELS_FILE_KEY}')
+    save_models(s3, models)
 
     config = { 'name': 'config', 'current_group': 0 }
     ddb.put_item(TableName=MODELS_TABLE, Item=ddbjson.dumps(config, as_dict=True))
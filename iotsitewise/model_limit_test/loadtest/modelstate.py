@@ -0,0 +1,127 @@
+import copy
+import json
+import os
+from pathlib import Path
+
+
+# Number of delta objects to collect before they are merged back into the models file
+COMPACT_AFTER_DELTAS = 20
+
+
+def delta_prefix(models_file_key):
+    return f'{models_file_key}.deltas/'
+
+
+def apply_deltas(models, deltas):
+    models_by_name = {m['name']: m for m in models['models']}
+    for delta in deltas:
+        for name, changes in delta.items():
+            models_by_name[name].update(changes)
+    return models
+
+
+class S3ModelState:
+    """
+    Stores the models file in S3 as the full file plus one small delta object per save,
+    holding only the models that changed. Every COMPACT_AFTER_DELTAS saves, the deltas are
+    merged back into the models file.
+
+    The models returned by load() are the caller's working copy. Only the saved changes are
+    ever written, whatever the caller does to its copy.
+    """
+
+    def __init__(self, s3, bucket, models_file_key):
+        self.s3 = s3
+        self.bucket = bucket
+        self.models_file_key = models_file_key
+        self.prefix = delta_prefix(models_file_key)
+        self.delta_keys = []
+        # The models file with every saved delta applied
+        self.models = None
+
+    async def _get_json(self, key):
+        response = await self.s3.get_object(Bucket=self.bucket, Key=key)
+        async with response['Body'] as stream:
+            file_content = await stream.read()
+        return json.loads(file_content.decode('utf-8'))
+
+    async def _put_json(self, key, obj):
+        await self.s3.put_object(Body=json.dumps(obj), Bucket=self.bucket, Key=key, ContentType='application/json')
+
+    async def load(self):
+        models = await self._get_json(self.models_file_key)
+        paginator = self.s3.get_paginator('list_objects_v2')
+        self.delta_keys = []
+        async for page in paginator.paginate(Bucket=self.bucket, Prefix=self.prefix):
+            self.delta_keys.extend(obj['Key'] for obj in page.get('Contents', []))
+        # Keys are zero padded sequence numbers, so they sort in the order they were saved
+        self.delta_keys.sort()
+        self.models = apply_deltas(models, [await self._get_json(key) for key in self.delta_keys])
+        return copy.deepcopy(self.models)
+
+    async def save(self, changes):
+        if changes:
+            seq = int(self.delta_keys[-1][len(self.prefix):].split('.')[0]) + 1 if self.delta_keys else 0
+            key = f'{self.prefix}{seq:08d}.json'
+            await self._put_json(key, changes)
+            self.delta_keys.append(key)
+            apply_deltas(self.models, [changes])
+            print(f'Saved {len(changes)} model changes to s3://{self.bucket}/{key}')
+        if len(self.delta_keys) >= COMPACT_AFTER_DELTAS:
+            await self.compact()
+
+    async def compact(self):
+        # The deltas are only removed once the models file includes them, and applying them
+        # again is harmless, so an interrupted compaction doesn't lose any changes
+        await self._put_json(self.models_file_key, self.models)
+        for i in range(0, len(self.delta_keys), 1000):
+            await self.s3.delete_objects(Bucket=self.bucket, Delete={
+                'Objects': [{'Key': key} for key in self.delta_keys[i:i+1000]], 'Quiet': True})
+        print(f'Compacted {len(self.delta_keys)} deltas into s3://{self.bucket}/{self.models_file_key}')
+        self.delta_keys = []
+
+
+class LocalModelState:
+    """
+    The same layout as S3ModelState in a local directory, for running the Lambda functions
+    offline
+    """
+
+    def __init__(self, directory, models_file_key):
+        self.models_file = Path(directory) / models_file_key
+        self.delta_dir = Path(directory) / delta_prefix(models_file_key)
+        self.delta_files = []
+        self.models = None
+
+    async def load(self):
+        models = json.loads(self.models_file.read_text())
+        self.delta_files = sorted(self.delta_dir.glob('*.json')) if self.delta_dir.exists() else []
+        self.models = apply_deltas(models, [json.loads(f.read_text()) for f in self.delta_files])
+        return copy.deepcopy(self.models)
+
+    async def save(self, changes):
+        if changes:
+            self.delta_dir.mkdir(parents=True, exist_ok=True)
+            seq = int(self.delta_files[-1].stem) + 1 if self.delta_files else 0
+            delta_file = self.delta_dir / f'{seq:08d}.json'
+            delta_file.write_text(json.dumps(changes))
+            self.delta_files.append(delta_file)
+            apply_deltas(self.models, [changes])
+            print(f'Saved {len(changes)} model changes to {delta_file}')
+        if len(self.delta_files) >= COMPACT_AFTER_DELTAS:
+            await self.compact()
+
+    async def compact(self):
+        self.models_file.write_text(json.dumps(self.models))
+        for delta_file in self.delta_files:
+            delta_file.unlink()
+        print(f'Compacted {len(self.delta_files)} deltas into {self.models_file}')
+        self.delta_files = []
+
+
+def get_model_state(s3, bucket, models_file_key):
+    # MODEL_STATE_DIR keeps the models file on the local filesystem instead of S3
+    state_dir = os.environ.get('MODEL_STATE_DIR')
+    if state_dir:
+        return LocalModelState(state_dir, models_file_key)
+    return S3ModelState(s3, bucket, models_file_key)
@@ -0,0 +1,145 @@
+import asyncio
+import heapq
+import itertools
+import os
+
+from botocore.exceptions import BotoCoreError, ClientError
+
+
+# Budget for all the DescribeAssetModel calls of an invocation
+DESCRIBE_TPS = float(os.environ.get('DESCRIBE_TPS', '5'))
+# A model is checked again after a quarter of its age, within these bounds (seconds)
+MIN_POLL_INTERVAL = 1
+MAX_POLL_INTERVAL = 15
+DELETED = 'DELETED'
+
+
+class StatusPoller:
+    """
+    Waits for AssetModels to reach a state, checking all of the pending models from a single
+    coroutine instead of one polling loop per model.
+
+    Models are checked in the order they're due, at no more than DESCRIBE_TPS calls per
+    second. The longer a model has been pending, the less often it's checked, so models that
+    take a while don't use up the describe budget of the ones that are about to finish.
+    """
+
+    def __init__(self, sitewise, max_tps=DESCRIBE_TPS):
+        self.sitewise = sitewise
+        self.call_interval = 1 / max_tps
+        # model ID -> (wanted state, future, time added, deadline, number of checks)
+        self.pending = {}
+        # Heap of (next check time, sequence number, model ID)
+        self.schedule = []
+        self.seq = itertools.count()
+        self.wakeup = asyncio.Event()
+        self.task = None
+        self.num_describes = 0
+
+    async def __aenter__(self):
+        self.task = asyncio.ensure_future(self._run())
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.task.cancel()
+        try:
+            await self.task
+        except asyncio.CancelledError:
+            pass
+        for _, future, *_ in self.pending.values():
+            future.cancel()
+        print(f'Made {self.num_describes} DescribeAssetModel calls')
+
+    def wait_active(self, asset_model_id, timeout=300):
+        return self._wait(asset_model_id, 'ACTIVE', timeout)
+
+    def wait_deleted(self, asset_model_id, timeout=180):
+        return self._wait(asset_model_id, DELETED, timeout)
+
+    def _wait(self, asset_model_id, state, timeout):
+        if asset_model_id in self.pending:
+            return self.pending[asset_model_id][1]
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        now = loop.time()
+        self.pending[asset_model_id] = (state, future, now, now + timeout, 0)
+        self._schedule(asset_model_id, now + MIN_POLL_INTERVAL)
+        return future
+
+    def _schedule(self, asset_model_id, check_time):
+        heapq.heappush(self.schedule, (check_time, next(self.seq), asset_model_id))
+        self.wakeup.set()
+
+    def _resolve(self, asset_model_id, exception=None):
+        _, future, *_ = self.pending.pop(asset_model_id)
+        if future.done():
+            return
+        if exception:
+            future.set_exception(exception)
+        else:
+            future.set_result(asset_model_id)
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        last_call = -self.call_interval
+        while True:
+            if self.schedule:
+                check_time, _, asset_model_id = self.schedule[0]
+                delay = max(check_time, last_call + self.call_interval) - loop.time()
+            else:
+                delay = None
+
+            if delay is None or delay > 0:
+                # Sleeps until the next check is due, or until a model is added
+                self.wakeup.clear()
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), timeout=delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            heapq.heappop(self.schedule)
+            if asset_model_id in self.pending:
+                last_call = loop.time()
+                await self._check(asset_model_id)
+
+    async def _check(self, asset_model_id):
+        loop = asyncio.get_running_loop()
+        state, future, added, deadline, num_checks = self.pending[asset_model_id]
+        if future.cancelled():
+            del self.pending[asset_model_id]
+            return
+
+        self.num_describes += 1
+        status = None
+        try:
+            sw_model = await self.sitewise.describe_asset_model(assetModelId=asset_model_id)
+            status = sw_model['assetModelStatus']
+        except ClientError as e:
+            error_code = e.response['Error']['Code']
+            if error_code == 'ResourceNotFoundException' and state == DELETED:
+                self._resolve(asset_model_id)
+                return
+            if error_code != 'ThrottlingException':
+                self._resolve(asset_model_id, e)
+                return
+        except (BotoCoreError, OSError, asyncio.TimeoutError) as e:
+            # Connection errors and timeouts are checked again later, like throttling
+            print(f'Failed to describe AssetModel {asset_model_id}: {e!r}')
+        except Exception as e:
+            # Only fails this model, the other models are still checked
+            self._resolve(asset_model_id, e)
+            return
+
+        now = loop.time()
+        if status and status['state'] == state:
+            self._resolve(asset_model_id)
+        elif status and status['state'] == 'FAILED':
+            self._resolve(asset_model_id, RuntimeError(f'AssetModel {asset_model_id} failed. Status: {status}'))
+        elif now >= deadline:
+            action = 'delete' if state == DELETED else 'create'
+            self._resolve(asset_model_id, RuntimeError(f'Failed to {action} AssetModel {asset_model_id} final status: {status}'))
+        else:
+            self.pending[asset_model_id] = (state, future, added, deadline, num_checks + 1)
+            interval = min(MAX_POLL_INTERVAL, max(MIN_POLL_INTERVAL, (now - added) / 4))
+            self._schedule(asset_model_id, now + interval)
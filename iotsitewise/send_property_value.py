@@ -1,14 +1,22 @@
 #!/usr/bin/env python3
 
+import asyncio
+import csv
 import json
+import math
 import os
 import re
 import textwrap
 import time
-from distutils.util import strtobool
+from datetime import datetime, timezone
+from pathlib import Path
 
 import boto3
 import click
+from aiobotocore.session import get_session
+from botocore.exceptions import ClientError
+
+from batch_put import AsyncBatchSender, iter_in_thread, put_with_retry, sender_client_config
 
 
 ALARM_STATES = {
@@ -34,30 +42,74 @@ ALARM_OPERATORS = {
     '!=': 'NOT_EQUAL'
 }
 
+TYPE_CACHE_FILE = Path.home() / '.cache' / 'sitewise_property_types.json'
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+# BatchPutAssetPropertyValue limits
+MAX_ENTRIES_PER_REQUEST = 10
+MAX_VALUES_PER_ENTRY = 10
 
-class NullValue:
-    def __init__(self, value_type):
-        self.value_type = value_type
+
+class PropertyTypeCache:
+    """
+    Data types of asset properties (and data streams by alias), looked up once with the
+    DescribeAssetProperty/DescribeTimeSeries APIs and saved to a local json file.
+    """
+
+    def __init__(self, filename=TYPE_CACHE_FILE):
+        self.filename = Path(filename)
+        self.data_types = json.loads(self.filename.read_text()) if self.filename.exists() else {}
+        self.changed = False
 
     @staticmethod
-    def from_str(s):
-        if s.lower().startswith('null-'):
-            value_type = s.split('-')[1].upper()
-            return NullValue(value_type)
-        else:
-            raise ValueError('Not a null value')
+    def key(asset_id, property_id, alias):
+        return f'{asset_id}/{property_id}' if asset_id and property_id else f'alias:{alias}'
+
+    def load_tinydb(self, db_filename):
+        # Resources DB file created by factory_demo/create-sitewise-resources
+        from tinydb import TinyDB
+
+        db = TinyDB(db_filename)
+        models = {m['id']: m for m in db.table('models').all()}
+        for asset in db.table('assets').all():
+            model = models.get(asset.get('model_id'), {})
+            for property_id, data_type in model.get('property_data_type', {}).items():
+                key = self.key(asset['id'], property_id, None)
+                if self.data_types.get(key) != data_type:
+                    self.data_types[key] = data_type
+                    self.changed = True
+
+    def get(self, sitewise, asset_id, property_id, alias):
+        # Only uses the cached types if no client is given
+        key = self.key(asset_id, property_id, alias)
+        if key not in self.data_types and sitewise is not None:
+            try:
+                if asset_id and property_id:
+                    response = sitewise.describe_asset_property(assetId=asset_id, propertyId=property_id)
+                    prop = response.get('assetProperty') or response['compositeModel']['assetProperty']
+                    data_type = prop['dataType']
+                else:
+                    data_type = sitewise.describe_time_series(alias=alias)['dataType']
+            except ClientError as e:
+                print(f"Could not get data type of {key}: {e.response['Error']['Message']}")
+                return None
+            self.data_types[key] = data_type
+            self.changed = True
+        return self.data_types.get(key)
+
+    def save(self):
+        if self.changed:
+            self.filename.parent.mkdir(parents=True, exist_ok=True)
+            self.filename.write_text(json.dumps(self.data_types, indent=2))
+            self.changed = False
 
 
 def epoch_now():
     return int(time.time())
 
 
-def alarm_state_value(alarm_value):
-    values = re.split('(/|gt|ge|lt|le|eq|ne|>=|<=|!=|>|<|=)', alarm_value)
-    if len(values) == 1:
-        values.extend(['/', None, None, None])
-    state_code, _, measured_value, operator, threshold_value = values
-
+def new_alarm_value(state_code, measured_value=None, operator=None, threshold_value=None):
     value = { 'stateName': ALARM_STATES[state_code] }
     if measured_value and threshold_value:
         value['ruleEvaluation'] = {
@@ -70,44 +122,82 @@ def alarm_state_value(alarm_value):
     return value
 
 
-def cast_value(value_str):
-    if re.match('^-?(\d+)?(\.\d+)?$', value_str):
-        return float(value_str) if '.' in value_str else int(value_str)
-    try:
-        return bool(strtobool(value_str))
-    except ValueError: pass
-    try:
-        return NullValue.from_str(value_str)
-    except ValueError: pass
-    try:
-        return json.dumps(alarm_state_value(value_str))
-    except KeyError: pass
-    return value_str
-
-
-def _create_property_value(value_str):
-    value = cast_value(value_str)
-
-    if isinstance(value, bool):
-        return {'booleanValue': value}
-    elif isinstance(value, int):
-        return {'integerValue': value}
-    elif isinstance(value, float):
-        return {'doubleValue': value}
-    elif isinstance(value, NullValue):
-        return {'nullValue': {'valueType': value.value_type}}
+def alarm_state_value(alarm_value):
+    values = re.split('(/|gt|ge|lt|le|eq|ne|>=|<=|!=|>|<|=)', alarm_value)
+    if len(values) == 1:
+        values.extend(['/', None, None, None])
+    state_code, _, measured_value, operator, threshold_value = values
+    return new_alarm_value(state_code, measured_value, operator, threshold_value)
+
+
+# Single-pass classifier used when the data type is not known. Checked in order:
+# integer, double, boolean, alarm state (with an optional rule evaluation)
+VALUE_PATTERN = re.compile(r"""
+    (?P<integer>-?\d+)$
+    | (?P<double>-?\d*\.\d+)$
+    | (?P<boolean>(?i:y|yes|t|true|on|n|no|f|false|off))$
+    | (?P<alarm_state>ack|sd|a|d|n|l)
+      (?:(?:/|gt|ge|lt|le|eq|ne|!=|=)
+         (?P<measured>-?[\d.]+)(?P<operator>/|gt|ge|lt|le|eq|ne|!=|=)(?P<threshold>-?[\d.]+))?$
+""", re.VERBOSE)
+TRUE_VALUES = {'y', 'yes', 't', 'true', 'on', '1'}
+FALSE_VALUES = {'n', 'no', 'f', 'false', 'off', '0'}
+NULL_VALUE_TYPES = {'DOUBLE': 'D', 'INTEGER': 'I', 'BOOLEAN': 'B', 'STRING': 'S'}
+
+
+def parse_bool(value_str):
+    value = value_str.lower()
+    if value in TRUE_VALUES:
+        return True
+    if value in FALSE_VALUES:
+        return False
+    raise ValueError(f'invalid boolean value: {value_str!r}')
+
+
+def parse_value(value_str, data_type=None):
+    """
+    Returns the SiteWise value (e.g. {'doubleValue': 1.5}) for a value string. If the data
+    type of the property is given (DOUBLE, INTEGER, BOOLEAN, STRING or STRUCT for alarm
+    states) the value is converted directly, otherwise the type is inferred from the string.
+    """
+    if value_str[:5].lower() == 'null-':
+        null_type = value_str.split('-')[1].upper() or NULL_VALUE_TYPES.get(data_type, 'S')
+        return {'nullValue': {'valueType': null_type}}
+
+    if data_type == 'DOUBLE':
+        return {'doubleValue': float(value_str)}
+    elif data_type == 'INTEGER':
+        return {'integerValue': int(value_str)}
+    elif data_type == 'BOOLEAN':
+        return {'booleanValue': parse_bool(value_str)}
+    elif data_type == 'STRING':
+        return {'stringValue': value_str}
+    elif data_type == 'STRUCT':
+        return {'stringValue': json.dumps(alarm_state_value(value_str))}
+
+    match = VALUE_PATTERN.match(value_str)
+    if match is None:
+        return {'stringValue': value_str}
+    kind = match.lastgroup
+    if kind == 'integer':
+        return {'integerValue': int(value_str)}
+    elif kind == 'double':
+        return {'doubleValue': float(value_str)}
+    elif kind == 'boolean':
+        return {'booleanValue': parse_bool(value_str)}
     else:
-        return {'stringValue': value}
+        alarm_value = new_alarm_value(*match.group('alarm_state', 'measured', 'operator', 'threshold'))
+        return {'stringValue': json.dumps(alarm_value)}
 
 
-def create_property_value(timestamp_s, value_str, quality):
-    value = _create_property_value(value_str)
+def create_property_value(timestamp_s, value_str, quality, offset_nanos=0, data_type=None):
+    value = parse_value(value_str, data_type)
     quality = 'UNCERTAIN' if 'nullValue' in value else quality.upper()
     return {
         'value': value,
         'timestamp': {
             'timeInSeconds': timestamp_s,
-            'offsetInNanos': 0
+            'offsetInNanos': offset_nanos
         },
         'quality': quality
     }
@@ -124,32 +214,126 @@ def create_entry(entry_id, asset_id, property_id, alias, property_values):
     return entry
 
 
-def create_entries(asset_id, property_id, alias, value, quality):
-    property_values = [create_property_value(epoch_now(), value, quality)]
+def create_entries(asset_id, property_id, alias, value, quality, data_type=None):
+    property_values = [create_property_value(epoch_now(), value, quality, data_type=data_type)]
     return [create_entry(0, asset_id, property_id, alias, property_values)]
 
 
+def to_timestamp(timestamp_str):
+    # Epoch seconds (optionally fractional) or an ISO 8601 date time, in UTC if it has no offset
+    try:
+        seconds = float(timestamp_str)
+    except ValueError:
+        dt = datetime.fromisoformat(timestamp_str)
+        if dt.tzinfo is None:
+            dt = dt.replace(tzinfo=timezone.utc)
+        since_epoch = dt - EPOCH
+        return since_epoch.days * 86400 + since_epoch.seconds, since_epoch.microseconds * 1000
+    timestamp_s = math.floor(seconds)
+    offset_nanos = int(round((seconds - timestamp_s) * 1e9))
+    # Rounding can reach a whole second, which isn't a valid offsetInNanos
+    if offset_nanos == 1_000_000_000:
+        timestamp_s, offset_nanos = timestamp_s + 1, 0
+    return timestamp_s, offset_nanos
+
+
+def read_rows(file, file_format=None):
+    if file_format is None:
+        name = getattr(file, 'name', '')
+        file_format = 'ndjson' if name.endswith(('.ndjson', '.jsonl')) else 'csv'
+    if file_format == 'ndjson':
+        for line in file:
+            if line.strip():
+                yield json.loads(line)
+    else:
+        yield from csv.DictReader(file)
+
+
+def pack_entries(rows, data_type=None, get_data_type=None):
+    # Values for the same property are grouped into one entry (up to 10 values), and
+    # completed entries are grouped into one request (up to 10 entries)
+    pending = {}
+    data_types = {}
+    entries = []
+    for row_num, row in enumerate(rows, start=1):
+        key = (row.get('assetId'), row.get('propertyId'), row.get('propertyAlias'))
+        if key not in data_types:
+            data_types[key] = data_type or (get_data_type(*key) if get_data_type else None)
+        # A value that doesn't match the property's data type only skips its own row, as
+        # earlier batches may have been sent already
+        try:
+            timestamp_s, offset_nanos = to_timestamp(str(row['timestamp']))
+            property_value = create_property_value(timestamp_s, str(row['value']),
+                                                   row.get('quality') or 'good', offset_nanos,
+                                                   row.get('dataType') or data_types[key])
+        except ValueError as e:
+            print(f'Skipping row {row_num}: {e}')
+            continue
+        values = pending.setdefault(key, [])
+        values.append(property_value)
+        if len(values) == MAX_VALUES_PER_ENTRY:
+            entries.append(create_entry(len(entries), *key, pending.pop(key)))
+            if len(entries) == MAX_ENTRIES_PER_REQUEST:
+                yield entries
+                entries = []
+
+    for key, values in pending.items():
+        entries.append(create_entry(len(entries), *key, values))
+        if len(entries) == MAX_ENTRIES_PER_REQUEST:
+            yield entries
+            entries = []
+    if entries:
+        yield entries
+
+
+def get_error_messages(response):
+    return [error['errorMessage']
+            for entry in response.get('errorEntries', [])
+            for error in entry.get('errors', [])]
+
+
 def send_entries(iotsitewise_client, entries):
-    response = iotsitewise_client.batch_put_asset_property_value(entries=entries)
-    print("RequestId: ", response['ResponseMetadata']['RequestId'])
-    error_messages = [error['errorMessage']
-                      for entry in response.get('errorEntries', [])
-                      for error in entry.get('errors', [])]
-    error_messages = '\n'.join(error_messages)
+    responses, error_entries = put_with_retry(iotsitewise_client, entries)
+    for response in responses:
+        print("RequestId: ", response['ResponseMetadata']['RequestId'])
+    error_messages = '\n'.join(get_error_messages({'errorEntries': error_entries}))
     if error_messages:
         return f'Error(s): {error_messages}'
 
 
+async def send_batches(batches, max_in_flight):
+    session = get_session()
+    async with session.create_client('iotsitewise', config=sender_client_config(max_in_flight)) as sitewise:
+        sender = AsyncBatchSender(sitewise, max_window=max_in_flight)
+        # The batches are read and packed in a thread, as looking up the data type of a new
+        # property calls DescribeAssetProperty with the (blocking) boto3 client
+        error_entries = await sender.send_all(iter_in_thread(batches))
+    for message in get_error_messages({'errorEntries': error_entries}):
+        print(f'Error: {message}')
+
+
 def custom_doc(f):
     alarm_states = '\n        '.join(f'{k}: {v}' for k, v in ALARM_STATES.items())
     alarm_operators = '\n        '.join(f'{k}: {v}' for k, v in ALARM_OPERATORS.items())
     doc = f"""
     Sends a measurement to an Asset Property.
 
+    The data type of each property is looked up once (or loaded from a factory_demo resources
+    DB file) and saved locally, so values are sent with the right type the first time. The
+    type is only inferred from the value when it cannot be looked up.
+
+    \b
+    Bulk mode (-f/--from-file, use '-' for stdin)
+        Reads rows from a CSV file (with a header row) or an NDJSON file with the fields
+        assetId, propertyId, propertyAlias, timestamp, value, quality, dataType
+        The timestamp is in epoch seconds (can be fractional) or an ISO 8601 date time
+        (UTC unless it includes an offset, e.g. 2024-01-01T12:00:00+02:00)
+        The dataType field is optional, and overrides -t/--data-type for that row
+
     \b
     Specifying values
         <double>             Double (must include decimal point to differentiate from integers)
-        <integer>            Integer (will try again as double if rejected)
+        <integer>            Integer
         <boolean>            Boolean
         [s]                  <alarm state>
         [s]/[val][op][val]   <alarm state>/<measured value> <alarm operator> <threshold value>
@@ -187,23 +371,49 @@ def custom_doc(f):
 @click.option('-l', '--alias', help='Asset Property Alias')
 @click.option('-v', '--value', help='Value')
 @click.option('-q', '--quality', help='Quality (good, bad, uncertain)', default='good')
+@click.option('-t', '--data-type', type=click.Choice(['DOUBLE', 'INTEGER', 'BOOLEAN', 'STRING', 'STRUCT']),
+              help='Data type of the values (inferred from the value if not given)')
+@click.option('-f', '--from-file', type=click.File('r'), help='Send values from a CSV/NDJSON file')
+@click.option('--file-format', type=click.Choice(['csv', 'ndjson']), help='Input file format (default from file extension)')
+@click.option('-c', '--concurrency', type=int, default=32, show_default=True, help='Max requests in flight (bulk mode)')
+@click.option('--type-cache', 'type_cache_file', default=str(TYPE_CACHE_FILE), show_default=True,
+              help='File to save the property data types to')
+@click.option('--db', 'db_filename', help='Load property data types from a factory_demo resources DB file')
 @click.option('-d', '--dry-run', is_flag=True, help='Display request json')
 @custom_doc
-def main(asset_id, property_id, alias, value, quality, dry_run):
-    entries = create_entries(asset_id, property_id, alias, value, quality)
-
-    if dry_run:
-        print(json.dumps({'entries': entries}, indent=2))
-        return
-
-    iotsitewise_client = boto3.client('iotsitewise')
-    error_message = send_entries(iotsitewise_client, entries)
-    if error_message and 'Property value does not match data type DOUBLE' in error_message:
-        print('Trying again as double value')
-        entries = create_entries(asset_id, property_id, alias, str(float(value)))
+def main(asset_id, property_id, alias, value, quality, data_type, from_file, file_format, concurrency,
+         type_cache_file, db_filename, dry_run):
+    type_cache = PropertyTypeCache(type_cache_file)
+    if db_filename:
+        type_cache.load_tinydb(db_filename)
+    # Dry runs only use the data types that are already cached
+    iotsitewise_client = None if dry_run else boto3.client('iotsitewise')
+
+    def get_data_type(asset_id, property_id, alias):
+        return type_cache.get(iotsitewise_client, asset_id, property_id, alias)
+
+    try:
+        if from_file:
+            batches = pack_entries(read_rows(from_file, file_format), data_type, get_data_type)
+            if dry_run:
+                for entries in batches:
+                    print(json.dumps({'entries': entries}))
+            else:
+                asyncio.run(send_batches(batches, concurrency))
+            return
+
+        data_type = data_type or get_data_type(asset_id, property_id, alias)
+        entries = create_entries(asset_id, property_id, alias, value, quality, data_type)
+
+        if dry_run:
+            print(json.dumps({'entries': entries}, indent=2))
+            return
+
         error_message = send_entries(iotsitewise_client, entries)
-    if error_message:
-        print(error_message)
+        if error_message:
+            print(error_message)
+    finally:
+        type_cache.save()
 
 
 if __name__ == '__main__':
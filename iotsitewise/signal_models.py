@@ -0,0 +1,130 @@
+import numpy as np
+
+
+# Every model takes the previous values of its properties (NaN if unknown), the timestamps
+# (epoch seconds) of the ticks to generate and the per-property parameters, and returns a
+# (properties x ticks) array of values, generated for all of its properties at once.
+SIGNAL_MODELS = {}
+
+DEFAULT_MODEL = 'random_walk'
+DEFAULT_PARAMS = {
+    'mean': 50.0,           # Mean level (gaussian, sinusoid offset, mean reversion target)
+    'sigma': 1.0,           # Standard deviation of the noise/random walk steps
+    'reversion': 0.0,       # Fraction of the distance to the mean recovered each tick (random_walk)
+    'amplitude': 10.0,      # sinusoid
+    'period': 3600.0,       # sinusoid period in seconds
+    'phase': 0.0,           # sinusoid phase in radians
+    'step_prob': 0.05,      # Probability of a level change each tick (step)
+    'step_size': 10.0,      # Standard deviation of a level change (step)
+    'dropout': 0.0,         # Probability of a value being sent as a null value (all models)
+}
+
+
+def signal_model(name):
+    def register(func):
+        SIGNAL_MODELS[name] = func
+        return func
+    return register
+
+
+def _start_values(prev, default):
+    return np.where(np.isnan(prev), default, prev)
+
+
+@signal_model('random_walk')
+def random_walk(prev, timestamps, params, rng):
+    num_properties, num_ticks = len(prev), len(timestamps)
+    init = np.isnan(prev)
+    start = _start_values(prev, rng.uniform(low=1, high=100, size=num_properties))
+    steps = rng.normal(0, 1, size=(num_properties, num_ticks)) * params['sigma'][:, np.newaxis]
+    # New properties start from their initial value instead of taking a step
+    steps[init, 0] = 0
+
+    reversion = params['reversion']
+    if not reversion.any():
+        return start[:, np.newaxis] + np.cumsum(steps, axis=1)
+
+    values = np.empty((num_properties, num_ticks))
+    current = start
+    for tick in range(num_ticks):
+        current = current + reversion * (params['mean'] - current) + steps[:, tick]
+        values[:, tick] = current
+    return values
+
+
+@signal_model('sinusoid')
+def sinusoid(prev, timestamps, params, rng):
+    angle = 2 * np.pi * timestamps[np.newaxis, :] / params['period'][:, np.newaxis] + params['phase'][:, np.newaxis]
+    noise = rng.normal(0, 1, size=angle.shape) * params['sigma'][:, np.newaxis]
+    return params['mean'][:, np.newaxis] + params['amplitude'][:, np.newaxis] * np.sin(angle) + noise
+
+
+@signal_model('step')
+def step(prev, timestamps, params, rng):
+    shape = (len(prev), len(timestamps))
+    start = _start_values(prev, params['mean'])
+    changes = rng.random(size=shape) < params['step_prob'][:, np.newaxis]
+    jumps = np.where(changes, rng.normal(0, 1, size=shape) * params['step_size'][:, np.newaxis], 0)
+    return start[:, np.newaxis] + np.cumsum(jumps, axis=1)
+
+
+@signal_model('gaussian')
+def gaussian(prev, timestamps, params, rng):
+    noise = rng.normal(0, 1, size=(len(prev), len(timestamps)))
+    return params['mean'][:, np.newaxis] + noise * params['sigma'][:, np.newaxis]
+
+
+def _column(config, name, default, num_properties, dtype):
+    if name not in config:
+        return np.full(num_properties, default, dtype=dtype)
+    values = np.asarray(config[name], dtype=dtype)
+    if dtype is object:
+        return np.where([v is None or v != v or v == '' for v in values], default, values)
+    return np.where(np.isnan(values), default, values)
+
+
+def _num_properties(config):
+    if isinstance(config, dict):
+        return len(next(iter(config.values())))
+    return len(config)
+
+
+def get_params(config, num_properties):
+    """
+    Reads the per-property model and parameters from the config (a DataFrame or a dict of
+    columns), using the defaults for missing columns or empty values.
+    """
+    models = _column(config, 'model', DEFAULT_MODEL, num_properties, object)
+    params = {name: _column(config, name, default, num_properties, np.float64)
+              for name, default in DEFAULT_PARAMS.items()}
+    return models, params
+
+
+def generate(config, prev, timestamps, rng):
+    """
+    Generates values for every property and timestamp, calling each model once for all of
+    the properties using it. Returns a (properties x ticks) array.
+    """
+    num_properties = _num_properties(config)
+    models, params = get_params(config, num_properties)
+    prev = np.full(num_properties, np.nan) if prev is None else np.asarray(prev, dtype=np.float64)
+    timestamps = np.asarray(timestamps, dtype=np.float64)
+
+    values = np.empty((num_properties, len(timestamps)))
+    for name in np.unique(models):
+        if name not in SIGNAL_MODELS:
+            raise ValueError(f'Unknown signal model: {name}')
+        idx = np.flatnonzero(models == name)
+        model_params = {k: v[idx] for k, v in params.items()}
+        values[idx] = SIGNAL_MODELS[name](prev[idx], timestamps, model_params, rng)
+    return values
+
+
+def apply_dropout(config, values, rng):
+    """
+    Returns a copy of the values with dropped out values replaced by NaN (to be sent as
+    null values). The generated values themselves are kept as the model state.
+    """
+    _, params = get_params(config, len(values))
+    dropped = rng.random(size=values.shape) < params['dropout'][:, np.newaxis]
+    return np.where(dropped, np.nan, values)